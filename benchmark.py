@@ -0,0 +1,885 @@
+'''Replays saved responses through the wpull hooks of furaffinity.py.
+
+Every response record of the given WARC files (e.g. the WARCs of earlier
+items, kept with --keep-data) is passed through accept_url,
+handle_pre_response, handle_response and get_urls, and the URLs get_urls
+returns through accept_url, the same way wpull does. Nothing is fetched.
+
+    python3 benchmark.py [--repeat N] [--label TEXT] FILE.warc.gz ...
+
+Pages per second, URLs per second and the peak memory of the hooks are
+printed and appended to benchmark_results.jsonl together with the current
+commit, so runs on different commits can be compared.
+
+    python3 benchmark.py --frontier 100000
+
+instead crawls a made-up profile of about that many URLs through a copy of
+wpull's database, once as wpull uses it and once with frontier.py, and
+compares the time, the database size and the peak memory.
+
+    python3 benchmark.py [FILE.warc.gz ...] --url-filter
+
+times the URL rules of furaffinity.py, compiled into URLFilter, against
+the chain of checks accept_url used to make, on the URLs of the given
+WARC files or on 100,000 made-up ones, and checks they agree.
+
+    python3 benchmark.py --pages FILE.warc.gz ...
+
+times PageAnalysis, which get_urls asks about furaffinity.net pages,
+against decoding each page and scanning the text once per question, the
+way get_urls used to, on the pages in the WARC files.
+
+    python3 benchmark.py --startup [PYTHON]
+
+starts pipeline.py the way run-pipeline loads it, first without and then
+with its startup cache, in a copy of this directory so state/ is left
+alone, and reports how long loading it took.
+'''
+import argparse
+import collections
+import contextlib
+import functools
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import zlib
+
+import cdnfilter
+import frontier
+
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'furaffinity.py')
+
+PAGE_KINDS = (
+    ('profile', '/user/'),
+    ('gallery', '/gallery/'),
+    ('scraps', '/scraps/'),
+    ('favorites', '/favorites/'),
+    ('view', '/view/'),
+    ('full', '/full/'),
+    ('journal', '/journal/'),
+    ('journals', '/journals/'),
+    ('login', '/login/'),
+)
+
+
+class FakeHook(object):
+    '''Stands in for the wpull_hook object wpull gives the script.'''
+    class Actions(object):
+        NORMAL = 'normal'
+        RETRY = 'retry'
+        FINISH = 'finish'
+        STOP = 'stop'
+
+    class Callbacks(object):
+        pass
+
+    def __init__(self):
+        self.actions = self.Actions()
+        self.callbacks = self.Callbacks()
+
+
+def decode_body(headers, body):
+    '''Undoes the transfer and content encodings wpull stores in the WARC.'''
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        position = 0
+
+        while True:
+            line_end = body.find(b'\r\n', position)
+
+            if line_end == -1:
+                break
+
+            size = int(body[position:line_end].split(b';')[0] or b'0', 16)
+
+            if not size:
+                break
+
+            chunks.append(body[line_end + 2:line_end + 2 + size])
+            position = line_end + 4 + size
+
+        body = b''.join(chunks)
+
+    encoding = headers.get('content-encoding', '').lower()
+
+    if encoding == 'gzip':
+        body = gzip.decompress(body)
+    elif encoding == 'deflate':
+        body = zlib.decompress(body)
+
+    return body
+
+
+def page_kind(url, status_code):
+    if 'facdn.net' in url:
+        return 'cdn'
+
+    if status_code == 404:
+        return '404'
+
+    path = urllib.parse.urlsplit(url).path
+
+    for kind, prefix in PAGE_KINDS:
+        if path.startswith(prefix):
+            return kind
+
+    return 'other'
+
+
+def load_responses(paths, body_dir):
+    '''Returns (url, status code, body file, content type) of every response.'''
+    responses = []
+
+    for path in paths:
+        for fields, content in cdnfilter.read_warc_records(path):
+            if fields.get(b'warc-type') != b'response' or not content.startswith(b'HTTP/'):
+                continue
+
+            head, _, body = content.partition(b'\r\n\r\n')
+            lines = head.decode('latin1').split('\r\n')
+            headers = {}
+
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            try:
+                status_code = int(lines[0].split(' ', 2)[1])
+                body = decode_body(headers, body)
+            except (IndexError, ValueError, OSError, zlib.error):
+                continue
+
+            body_path = os.path.join(body_dir, '{0}.body'.format(len(responses)))
+
+            with open(body_path, 'wb') as file:
+                file.write(body)
+
+            responses.append((
+                fields[b'warc-target-uri'].decode('utf8', 'replace'),
+                status_code,
+                body_path,
+                headers.get('content-type', ''),
+            ))
+
+    return responses
+
+
+def load_script(item_dir, item_name):
+    '''Runs furaffinity.py for an item; returns the globals it leaves.'''
+    os.environ['item_dir'] = item_dir
+    os.environ['item_name'] = item_name
+
+    for name in ('rate_file', 'cdn_filter', 'hook_profile', 'batch_item_names'):
+        os.environ.pop(name, None)
+
+    script_globals = {'wpull_hook': FakeHook(), '__name__': 'furaffinity'}
+
+    with open(SCRIPT_PATH) as file:
+        exec(compile(file.read(), SCRIPT_PATH, 'exec'), script_globals)
+
+    return script_globals
+
+
+def url_info_for(url):
+    parts = urllib.parse.urlsplit(url)
+
+    return {
+        'url': url,
+        'scheme': parts.scheme,
+        'hostname': parts.hostname or '',
+        'path': parts.path,
+        'query': parts.query,
+    }
+
+
+def replay(callbacks, responses):
+    '''Runs the responses through the hooks once; returns the counters.'''
+    counts = collections.Counter()
+
+    for url, status_code, body_path, content_type in responses:
+        url_info = url_info_for(url)
+        record_info = {'url': url, 'referrer': '', 'level': 0, 'inline': False}
+        response_info = {'status_code': status_code, 'reason': ''}
+
+        counts['urls'] += 1
+        counts['pages'] += 1
+        callbacks.accept_url(url_info, record_info, True, {})
+
+        try:
+            callbacks.handle_pre_response(url_info, record_info, response_info)
+            callbacks.handle_response(url_info, record_info, response_info)
+
+            if status_code == 200 and 'html' in content_type:
+                new_urls = callbacks.get_urls(body_path, url_info, {})
+            else:
+                new_urls = ()
+        except Exception:
+            counts['errors'] += 1
+            continue
+
+        for new_url in new_urls or ():
+            counts['urls'] += 1
+            new_record_info = {'url': new_url['url'], 'referrer': url, 'level': 1, 'inline': False}
+            callbacks.accept_url(url_info_for(new_url['url']), new_record_info, True, {})
+
+    return counts
+
+
+def run(responses, item_name, trace_memory=False):
+    item_dir = tempfile.mkdtemp(prefix='fa-benchmark-')
+
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            callbacks = load_script(item_dir, item_name)['wpull_hook'].callbacks
+
+            if trace_memory:
+                tracemalloc.start()
+
+            started = time.perf_counter()
+            counts = replay(callbacks, responses)
+            seconds = time.perf_counter() - started
+
+            if trace_memory:
+                counts['peak_memory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+    finally:
+        shutil.rmtree(item_dir)
+
+    return seconds, counts
+
+
+# The tables wpull 1.0 creates, as SQLAlchemy emits them
+WPULL_SCHEMA = (
+    'CREATE TABLE url_strings (id INTEGER NOT NULL PRIMARY KEY, url VARCHAR NOT NULL)',
+    'CREATE UNIQUE INDEX ix_url_strings_url ON url_strings (url)',
+    'CREATE TABLE urls (id INTEGER NOT NULL PRIMARY KEY, url_str_id INTEGER NOT NULL, '
+    'status VARCHAR(11) NOT NULL, try_count INTEGER NOT NULL, level INTEGER NOT NULL, '
+    'top_url_str_id INTEGER, status_code INTEGER, referrer_id INTEGER, inline INTEGER, '
+    'link_type VARCHAR(9), post_data VARCHAR, filename VARCHAR)',
+    'CREATE UNIQUE INDEX ix_urls_url_str_id ON urls (url_str_id)',
+    'CREATE INDEX ix_urls_status ON urls (status)',
+)
+
+# Thumbnails, views and their files per gallery page, plus the page itself
+URLS_PER_GALLERY_PAGE = 1 + 48 * 3
+
+
+def synthetic_links(url, num_pages):
+    '''Returns the links wpull would find on a page of the made-up profile.'''
+    parts = url.rstrip('/').split('/')
+
+    if '/gallery/' in url:
+        page = int(parts[-1])
+        links = ['https://www.furaffinity.net/gallery/benchmark/{0}/'.format(page + 1)] \
+            if page < num_pages else []
+
+        for number in range(page * 48, page * 48 + 48):
+            links.append('https://www.furaffinity.net/view/{0}/'.format(number))
+            links.append('https://t.facdn.net/{0}@200-1400000000.jpg'.format(number))
+
+        return links + ['https://www.furaffinity.net/themes/beta/css/ui_theme_dark.css']
+
+    if '/view/' in url:
+        number = int(parts[-1])
+        commenters = random.Random(number).sample(range(2000), 5)
+
+        return ['https://d.facdn.net/art/benchmark/{0}/{0}.benchmark.png'.format(number)] + \
+            ['https://a.facdn.net/{0}/commenter{0}.gif'.format(user) for user in commenters] + \
+            ['https://www.furaffinity.net/themes/beta/css/ui_theme_dark.css']
+
+    return []
+
+
+def crawl_synthetic_profile(db_path, num_urls, use_frontier, memory_limit, results):
+    '''Crawls the made-up profile the way wpull uses its database.'''
+    num_pages = max(1, num_urls // URLS_PER_GALLERY_PAGE)
+    connection = sqlite3.connect(db_path)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+
+    if use_frontier:
+        frontier.tune(connection, memory_limit)
+        store = frontier.FrontierStore(db_path, db_path + '.bloom', memory_limit)
+    else:
+        store = None
+
+    for statement in WPULL_SCHEMA:
+        connection.execute(statement)
+
+    seed = 'https://www.furaffinity.net/gallery/benchmark/1/'
+
+    def add_many(urls, level, referrer):
+        with connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO url_strings (url) VALUES (?)',
+                [(url,) for url in urls + [referrer, seed]])
+            connection.executemany(
+                'INSERT OR IGNORE INTO urls (status, try_count, level, url_str_id, '
+                'referrer_id, top_url_str_id) VALUES (\'todo\', 0, ?, '
+                '(SELECT id FROM url_strings WHERE url = ?), '
+                '(SELECT id FROM url_strings WHERE url = ?), '
+                '(SELECT id FROM url_strings WHERE url = ?))',
+                [(level, url, referrer, seed) for url in urls])
+
+    add_many([seed], 0, seed)
+    tries = 0
+    peak_bytes = 0
+    started = time.perf_counter()
+
+    while True:
+        with connection:
+            row = connection.execute(
+                'SELECT urls.id, url_strings.url, urls.level FROM urls '
+                'JOIN url_strings ON urls.url_str_id = url_strings.id '
+                'WHERE urls.status = \'todo\' LIMIT 1').fetchone()
+
+            if not row:
+                break
+
+            connection.execute('UPDATE urls SET status = \'in_progress\' WHERE id = ?', row[:1])
+
+        url_id, url, level = row
+        links = synthetic_links(url, num_pages)
+
+        if store:
+            links = [link for link in links if link not in store]
+
+        if links:
+            add_many(links, level + 1, url)
+
+        with connection:
+            connection.execute(
+                'UPDATE urls SET status = \'done\', try_count = try_count + 1 '
+                'WHERE url_str_id = (SELECT id FROM url_strings WHERE url = ? LIMIT 1)', (url,))
+
+        tries += 1
+
+        if store and tries % frontier.COMPACT_INTERVAL == 0:
+            store.compact()
+
+        if tries % 1000 == 0:
+            peak_bytes = max(peak_bytes, database_size(db_path))
+
+    seconds = time.perf_counter() - started
+    peak_bytes = max(peak_bytes, database_size(db_path))
+    rows = connection.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+    connection.close()
+
+    results.put({
+        'tries': tries,
+        'seconds': seconds,
+        'tries_per_second': tries / seconds,
+        'peak_database_bytes': peak_bytes,
+        'rows_left': rows,
+        'peak_memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    })
+
+
+def database_size(db_path):
+    return sum(os.path.getsize(path) for path in (db_path, db_path + '-wal', db_path + '.bloom')
+               if os.path.exists(path))
+
+
+def run_frontier(num_urls, memory_limit):
+    '''Runs crawl_synthetic_profile with and without the frontier store.
+
+    Each run gets a process of its own so their peak memory can be told
+    apart.
+    '''
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='fa-benchmark-frontier-')
+
+    try:
+        for mode, use_frontier in (('wpull', False), ('frontier', True)):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=crawl_synthetic_profile, args=(
+                os.path.join(work_dir, mode + '.db'), num_urls, use_frontier, memory_limit, queue))
+            process.start()
+            results[mode] = queue.get()
+            process.join()
+    finally:
+        shutil.rmtree(work_dir)
+
+    return results
+
+
+# One URL for each rule of URL_REJECT_RULES, mixed into the made-up URLs
+REJECTED_URLS = (
+    'https://www.furaffinity.net/themes/classic/img/logo.png',
+    'https://ssl.google-analytics.com/ga.js',
+    'https://www.furaffinity.net/commissions/benchmark/add/',
+    'http://puu.sh/benchmark.png',
+    'https://pagead2.googlesyndication.com/pagead/show_ads.js',
+    'https://d.facdn.net/art/',
+    'https://d.facdn.net/art/benchmark/',
+    'http://d.facdn.net/art/zekromlover/1398041825.zekromlover_fuleco-300x300_1_.gif',
+    'http://static.zoovy.com/img/benchmark.png',
+)
+
+
+def chained_url_check(item_name, url):
+    '''Returns whether the URL is rejected, checking the rules one by one.
+
+    These are the checks accept_url made before they were compiled into
+    URLFilter, to compare it against.
+    '''
+    return (
+        '/themes/classic/' in url or
+        'google-analytics.com' in url or
+        'google.com/analytics' in url or
+        'gstatic.com/analytics' in url or
+        re.search(r'/commissions/.*/(add|manage)/$', url) is not None or
+        'puu.sh/' in url or
+        'googleadservices.com' in url or
+        'googlesyndication.com/pagead/' in url or
+        'googletagservices.com' in url or
+        url.endswith('//d.facdn.net/art/') or url.endswith('//d.facdn.net/') or
+        re.match(r'^https?://d\.facdn\.net/art/.*/$', url) is not None or
+        url == 'http://d.facdn.net/art/zekromlover/1398041825.zekromlover_fuleco-300x300_1_.gif' or
+        (item_name == 'journal:5259901-5259950' and
+         re.match(r'https?://a\.facdn\.net/.*\.gif$', url) is not None) or
+        'static.zoovy.com' in url
+    )
+
+
+def warc_urls(paths):
+    '''Returns the URL of every response in the WARC files.'''
+    return [
+        fields[b'warc-target-uri'].decode('utf8', 'replace')
+        for path in paths for fields, dummy in cdnfilter.read_warc_records(path)
+        if fields.get(b'warc-type') == b'response'
+    ]
+
+
+def made_up_urls(num_urls):
+    '''Returns the URLs wpull would find crawling the made-up profile.'''
+    urls = []
+    page = 1
+
+    while len(urls) < num_urls:
+        gallery_url = 'https://www.furaffinity.net/gallery/benchmark/{0}/'.format(page)
+
+        for url in synthetic_links(gallery_url, page + 1):
+            urls.append(url)
+
+            if '/view/' in url:
+                urls.extend(synthetic_links(url, 0))
+
+        urls.extend(REJECTED_URLS)
+        page += 1
+
+    return urls[:num_urls]
+
+
+def fastest_run(check, inputs, repeat):
+    '''Returns the seconds of the fastest of `repeat` runs of check over inputs.'''
+    seconds = None
+
+    for dummy in range(repeat):
+        started = time.perf_counter()
+
+        for args in inputs:
+            check(*args)
+
+        run_seconds = time.perf_counter() - started
+        seconds = run_seconds if seconds is None else min(seconds, run_seconds)
+
+    return seconds
+
+
+def run_url_filter(urls, item_name, repeat):
+    '''Times both ways of checking the URLs; the fastest of `repeat` counts.'''
+    item_dir = tempfile.mkdtemp(prefix='fa-benchmark-')
+
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            url_filter = load_script(item_dir, item_name)['url_filter']
+    finally:
+        shutil.rmtree(item_dir)
+
+    checks = (
+        ('chained', functools.partial(chained_url_check, item_name)),
+        ('compiled', url_filter.match),
+    )
+    results = {}
+
+    for mode, check in checks:
+        seconds = fastest_run(check, [(url,) for url in urls], repeat)
+        results[mode] = {
+            'seconds': seconds,
+            'urls_per_second': len(urls) / seconds,
+            'rejected': sum(1 for url in urls if check(url)),
+        }
+
+    results['mismatches'] = sum(
+        1 for url in urls
+        if chained_url_check(item_name, url) != (url_filter.match(url) is not None))
+
+    return results
+
+
+VIEW_URL_RE = re.compile(r'^https?://(www\.)?furaffinity\.net/view/\d+')
+
+
+def scan_page_text(body_path, url):
+    '''Answers what get_urls wants to know about a page the old way.
+
+    The page is decoded and the text scanned once for each question, the
+    404 markers twice, as get_urls did before PageAnalysis.
+    '''
+    with open(body_path, 'r', encoding='utf8', errors='replace') as file:
+        text = file.read(1048576)
+
+    def is_404():
+        return (
+            'This user cannot be found.' in text or
+            'This user has voluntarily disabled access to their userpage.' in text or
+            'The journal you are trying to find is not in our database.' in text or
+            'The submission you are trying to find is not in our database.' in text
+        )
+
+    answers = {
+        'ok': (
+            'Commission Info</a>' in text or
+            '<b>Submission information:' in text or
+            'This user cannot be found.' in text or
+            'The journal you are trying to find is not in our database.' in text or
+            'The submission you are trying to find is not in our database.' in text
+        ),
+        '404': is_404(),
+        'logged_in': '/logout/' in text,
+        'adult': 'Toggle to hide Mature and Adult submissions.' in text,
+    }
+
+    if not is_404():
+        answers['usernames'] = [
+            match.group(1).strip('/') for match in re.finditer(r'href="/user/([^"]+)"', text)]
+        answers['pagination_empty'] = 'There are no submissions to list' in text
+
+        if VIEW_URL_RE.match(url):
+            answers['full_view'] = (
+                ' type="application/x-shockwave-flash"' in text and
+                ('facdn.net/art/' in text or '//d.facdn.netswf/' in text) and
+                ('">Download</a>' in text or '">Download </a>' in text)
+            ) or 'var is_full = 1;' in text
+
+    match = re.search(r'<a href="([^"]+)">Download</a>', text)
+    answers['download_url'] = match.group(1) if match else None
+
+    return answers
+
+
+def analyze_page(page_analysis, body_path, url):
+    '''Answers the same questions with PageAnalysis, as get_urls does now.'''
+    with open(body_path, 'rb') as file:
+        page = page_analysis(file.read(1048576))
+
+    answers = {
+        'ok': page.is_ok,
+        '404': page.is_404,
+        'logged_in': page.is_logged_in,
+        'adult': page.can_view_adult,
+    }
+
+    if not page.is_404:
+        answers['usernames'] = page.usernames
+        answers['pagination_empty'] = page.is_pagination_empty
+
+        if VIEW_URL_RE.match(url):
+            answers['full_view'] = page.is_full_view
+
+    answers['download_url'] = page.download_url
+
+    return answers
+
+
+def run_page_analysis(pages, item_name, repeat):
+    '''Times both ways of analyzing the pages; the fastest of `repeat` counts.'''
+    item_dir = tempfile.mkdtemp(prefix='fa-benchmark-')
+
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            page_analysis = load_script(item_dir, item_name)['PageAnalysis']
+    finally:
+        shutil.rmtree(item_dir)
+
+    num_bytes = sum(min(os.path.getsize(body_path), 1048576) for body_path, dummy in pages)
+    checks = (
+        ('text', scan_page_text),
+        ('bytes', functools.partial(analyze_page, page_analysis)),
+    )
+    results = {}
+
+    for mode, check in checks:
+        seconds = fastest_run(check, pages, repeat)
+        results[mode] = {
+            'seconds': seconds,
+            'pages_per_second': len(pages) / seconds,
+            'megabytes_per_second': num_bytes / 1048576 / seconds,
+        }
+
+    results['mismatches'] = sum(
+        1 for body_path, url in pages
+        if scan_page_text(body_path, url) != analyze_page(page_analysis, body_path, url))
+
+    return results
+
+
+PIPELINE_FILES = ('pipeline.py', 'furaffinity.py', 'helper.py')
+
+# Runs in the interpreter given to --startup, which may be Python 2 like
+# the seesaw of many warriors.
+STARTUP_CODE = '''
+import sys, time
+started = time.time()
+namespace = {"__name__": "pipeline", "__file__": "pipeline.py", "downloader": "benchmark"}
+exec(compile(open("pipeline.py").read(), "pipeline.py", "exec"), namespace)
+sys.stdout.write("\\nSTARTUP_SECONDS %f\\n" % (time.time() - started))
+'''
+
+
+def run_startup(python, repeat):
+    '''Starts pipeline.py `repeat` times without and then with the startup cache.'''
+    source_dir = os.path.dirname(SCRIPT_PATH)
+    work_dir = tempfile.mkdtemp(prefix='fa-benchmark-startup-')
+    cache_path = os.path.join(work_dir, 'state', 'startup_cache.json')
+    results = {}
+
+    try:
+        for name in PIPELINE_FILES:
+            shutil.copy2(os.path.join(source_dir, name), work_dir)
+
+        # The wpull candidates relative to the pipeline directory
+        for name in ('wpull', 'wpull_bootstrap'):
+            if os.path.exists(os.path.join(source_dir, name)):
+                os.symlink(os.path.join(source_dir, name), os.path.join(work_dir, name))
+
+        for mode in ('cold', 'warm'):
+            load_times = []
+            process_times = []
+
+            for dummy in range(repeat):
+                if mode == 'cold' and os.path.exists(cache_path):
+                    os.remove(cache_path)
+
+                started = time.perf_counter()
+                process = subprocess.run(
+                    [python, '-c', STARTUP_CODE], cwd=work_dir,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                process_times.append(time.perf_counter() - started)
+                match = re.search(rb'^STARTUP_SECONDS ([\d.]+)$', process.stdout, re.MULTILINE)
+
+                if process.returncode or not match:
+                    sys.exit('pipeline.py did not load:\n' +
+                             process.stdout.decode('utf8', 'replace')[-2000:])
+
+                load_times.append(float(match.group(1)))
+
+            results[mode] = {
+                'load_seconds': min(load_times),
+                'median_load_seconds': statistics.median(load_times),
+                'process_seconds': min(process_times),
+                'median_process_seconds': statistics.median(process_times),
+            }
+    finally:
+        shutil.rmtree(work_dir)
+
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(SCRIPT_PATH), stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_frontier_results(args):
+    print('Crawling a made-up profile of about {0} URLs...'.format(args.frontier))
+    runs = run_frontier(args.frontier, args.frontier_memory * 1048576)
+
+    for mode in ('wpull', 'frontier'):
+        print('{0:>8}: {tries} tries in {seconds:.1f}s ({tries_per_second:.0f}/s), '
+              'database peaked at {peak_database_bytes} bytes, {rows_left} rows left, '
+              'peak memory {peak_memory} bytes'.format(mode, **runs[mode]))
+
+    return {'benchmark': 'frontier', 'urls': args.frontier, 'frontier_memory': args.frontier_memory,
+            'runs': runs}
+
+
+def print_url_filter_results(args):
+    if args.warc_files:
+        urls = warc_urls(args.warc_files)
+    else:
+        urls = made_up_urls(args.url_filter)
+
+    if not urls:
+        sys.exit('No URLs found.')
+
+    print('Checking {0} URLs...'.format(len(urls)))
+    runs = run_url_filter(urls, args.item_name, args.repeat)
+
+    for mode in ('chained', 'compiled'):
+        print('{0:>8}: {seconds:.3f}s ({urls_per_second:.0f} URLs/s), {rejected} rejected'.format(
+            mode, **runs[mode]))
+
+    print('URLFilter is {0:.1f}x as fast, {1} verdicts differ'.format(
+        runs['chained']['seconds'] / runs['compiled']['seconds'], runs['mismatches']))
+
+    return {'benchmark': 'url_filter', 'urls': len(urls),
+            'corpus': sorted(os.path.basename(path) for path in args.warc_files),
+            'runs': runs}
+
+
+def print_page_results(args):
+    body_dir = tempfile.mkdtemp(prefix='fa-benchmark-bodies-')
+
+    try:
+        pages = [
+            (body_path, url)
+            for url, dummy, body_path, content_type in load_responses(args.warc_files, body_dir)
+            if 'furaffinity.net' in urllib.parse.urlsplit(url).hostname and 'html' in content_type
+        ]
+
+        if not pages:
+            sys.exit('No furaffinity.net pages found.')
+
+        print('Analyzing {0} pages...'.format(len(pages)))
+        runs = run_page_analysis(pages, args.item_name, args.repeat)
+    finally:
+        shutil.rmtree(body_dir)
+
+    for mode in ('text', 'bytes'):
+        print('{0:>5}: {seconds:.3f}s ({pages_per_second:.0f} pages/s, '
+              '{megabytes_per_second:.1f} MB/s)'.format(mode, **runs[mode]))
+
+    print('PageAnalysis is {0:.1f}x as fast, {1} pages analyzed differently'.format(
+        runs['text']['seconds'] / runs['bytes']['seconds'], runs['mismatches']))
+
+    return {'benchmark': 'pages', 'pages': len(pages),
+            'corpus': sorted(os.path.basename(path) for path in args.warc_files),
+            'runs': runs}
+
+
+def print_startup_results(args):
+    print('Starting pipeline.py with {0}, {1} times each...'.format(args.startup, args.repeat))
+    runs = run_startup(args.startup, args.repeat)
+
+    for mode, note in (('cold', 'no startup cache'), ('warm', 'startup cache')):
+        print('{0}: loaded in {load_seconds:.3f}s (median {median_load_seconds:.3f}s), '
+              'process {process_seconds:.3f}s (median {median_process_seconds:.3f}s) '
+              '- {1}'.format(mode, note, **runs[mode]))
+
+    return {'benchmark': 'startup', 'startup_python': args.startup, 'runs': runs}
+
+
+def print_hook_results(args):
+    body_dir = tempfile.mkdtemp(prefix='fa-benchmark-bodies-')
+
+    try:
+        responses = load_responses(args.warc_files, body_dir)
+
+        if not responses:
+            sys.exit('No responses found.')
+
+        kinds = collections.Counter(page_kind(url, status_code) for url, status_code, dummy, dummy in responses)
+        print('Replaying {0} responses: {1}'.format(
+            len(responses), ', '.join('{0} {1}'.format(count, kind) for kind, count in sorted(kinds.items()))))
+
+        seconds, counts = min((run(responses, args.item_name) for dummy in range(args.repeat)),
+                              key=lambda run_result: run_result[0])
+        dummy, memory_counts = run(responses, args.item_name, trace_memory=True)
+    finally:
+        shutil.rmtree(body_dir)
+
+    result = {
+        'corpus': sorted(os.path.basename(path) for path in args.warc_files),
+        'pages': counts['pages'],
+        'urls': counts['urls'],
+        'errors': counts['errors'],
+        'seconds': seconds,
+        'pages_per_second': counts['pages'] / seconds,
+        'urls_per_second': counts['urls'] / seconds,
+        'peak_memory': memory_counts['peak_memory'],
+    }
+
+    print('{pages} pages, {urls} URLs, {errors} errors in {seconds:.3f}s'.format(**result))
+    print('{pages_per_second:.0f} pages/s, {urls_per_second:.0f} URLs/s, '
+          'peak memory {peak_memory} bytes'.format(**result))
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the wpull hooks of furaffinity.py.')
+    parser.add_argument('warc_files', nargs='*', metavar='FILE.warc.gz')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed replays; the fastest counts')
+    parser.add_argument('--item-name', default='profile:benchmark',
+                        help='item name the script is loaded for')
+    parser.add_argument('--frontier', type=int, metavar='URLS',
+                        help='benchmark the wpull database on a made-up profile of this many URLs')
+    parser.add_argument('--frontier-memory', type=int, default=64, metavar='MIB',
+                        help='memory limit of the frontier store')
+    parser.add_argument('--url-filter', type=int, nargs='?', const=100000, metavar='URLS',
+                        help='benchmark the URL rules on the URLs of the WARC files, '
+                             'or on this many made-up URLs')
+    parser.add_argument('--pages', action='store_true',
+                        help='benchmark only the page analysis on the furaffinity.net pages of the WARC files')
+    parser.add_argument('--startup', nargs='?', const=sys.executable, metavar='PYTHON',
+                        help='benchmark loading pipeline.py with this interpreter '
+                             '(default: the one running this script)')
+    parser.add_argument('--label', default='', help='note stored with the results')
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help='file the results are appended to')
+    args = parser.parse_args()
+
+    if not args.frontier and not args.warc_files and args.url_filter is None and not args.startup:
+        parser.error('give WARC files, --frontier, --url-filter or --startup')
+
+    if args.pages and not args.warc_files:
+        parser.error('--pages needs WARC files')
+
+    result = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': current_commit(),
+        'label': args.label,
+        'python': sys.version.split()[0],
+    }
+
+    if args.startup:
+        result.update(print_startup_results(args))
+    elif args.frontier:
+        result.update(print_frontier_results(args))
+    elif args.url_filter is not None:
+        result.update(print_url_filter_results(args))
+    elif args.pages:
+        result.update(print_page_results(args))
+    else:
+        result.update(print_hook_results(args))
+
+    with open(args.results, 'a') as file:
+        file.write(json.dumps(result, sort_keys=True) + '\n')
+
+    print('Results appended to {0}.'.format(args.results))
+
+
+if __name__ == '__main__':
+    main()
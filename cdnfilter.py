@@ -0,0 +1,208 @@
+'''Bloom filter of facdn.net URLs that have already been archived.
+
+furaffinity.py consults it in accept_url so known files are not fetched
+again. The pipeline adds the files of every finished item; use this
+script to build or merge filters from existing CDX and WARC files:
+
+    python cdnfilter.py build OUTPUT.bloom FILE.cdx|FILE.warc.gz ...
+    python cdnfilter.py merge OUTPUT.bloom INPUT.bloom ...
+
+Runs on the same output hold OUTPUT.bloom.lock, so they take turns.
+'''
+from __future__ import print_function
+import fcntl
+import gzip
+import hashlib
+import io
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+
+MAGIC = b'FACDNBF1'
+HEADER = struct.Struct('<8sQI')
+
+# About 2.3 million URLs at a 0.1% false positive rate
+DEFAULT_NUM_BITS = 2 ** 25
+DEFAULT_NUM_HASHES = 10
+
+
+class BloomFilter(object):
+    def __init__(self, path, writable=False):
+        self.path = path
+        self._file = open(path, 'r+b' if writable else 'rb')
+
+        magic, self.num_bits, self.num_hashes = HEADER.unpack(self._file.read(HEADER.size))
+
+        if magic != MAGIC:
+            raise ValueError('Not a CDN filter file.')
+
+        self._bits = mmap.mmap(
+            self._file.fileno(), 0,
+            access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        )
+
+    @classmethod
+    def create(cls, path, num_bits=DEFAULT_NUM_BITS, num_hashes=DEFAULT_NUM_HASHES):
+        handle, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+
+        with os.fdopen(handle, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, num_bits, num_hashes))
+            file.truncate(HEADER.size + (num_bits + 7) // 8)
+
+        os.rename(temp_path, path)
+
+        return cls(path, writable=True)
+
+    def _positions(self, url):
+        digest = hashlib.sha1(url.encode('utf8')).digest()
+        hash_1, hash_2 = struct.unpack('<QQ', digest[:16])
+
+        for index in range(self.num_hashes):
+            yield HEADER.size * 8 + (hash_1 + index * hash_2) % self.num_bits
+
+    def __contains__(self, url):
+        bits = self._bits
+
+        for position in self._positions(url):
+            if not ord(bits[position // 8:position // 8 + 1]) & (1 << (position % 8)):
+                return False
+
+        return True
+
+    def add(self, url):
+        bits = self._bits
+
+        for position in self._positions(url):
+            offset = position // 8
+            value = ord(bits[offset:offset + 1]) | (1 << (position % 8))
+            bits[offset:offset + 1] = struct.pack('B', value)
+
+    def merge(self, other):
+        if (other.num_bits, other.num_hashes) != (self.num_bits, self.num_hashes):
+            raise ValueError('Filters have different sizes.')
+
+        chunk_size = 1048576
+
+        for offset in range(HEADER.size, len(self._bits), chunk_size):
+            mine = bytearray(self._bits[offset:offset + chunk_size])
+            theirs = bytearray(other._bits[offset:offset + chunk_size])
+
+            for index, value in enumerate(theirs):
+                mine[index] |= value
+
+            self._bits[offset:offset + chunk_size] = bytes(mine)
+
+    def flush(self):
+        self._bits.flush()
+
+    def close(self):
+        self._bits.close()
+        self._file.close()
+
+
+def is_cdn_url(url):
+    return 'facdn.net' in url
+
+
+def read_cdx_urls(path):
+    '''Yield the archived facdn.net URLs of a wpull CDX file.'''
+    with io.open(path, 'r', encoding='utf8') as file:
+        file.readline()
+
+        for line in file:
+            fields = line.split(u' ')
+
+            if len(fields) == 9 and fields[3] == u'200' and is_cdn_url(fields[0]):
+                yield fields[0]
+
+
+def read_warc_records(path):
+    '''Yield the header fields and content of each record of a (gzipped) WARC file.'''
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'rb') as file:
+        while True:
+            line = file.readline()
+
+            if not line:
+                return
+            if not line.startswith(b'WARC/'):
+                continue
+
+            fields = {}
+
+            for line in iter(file.readline, b'\r\n'):
+                if not line:
+                    return
+
+                name, _, value = line.partition(b':')
+                fields[name.strip().lower()] = value.strip()
+
+            yield fields, file.read(int(fields.get(b'content-length', 0)))
+
+
+def read_warc_urls(path):
+    '''Yield the archived facdn.net URLs of a (gzipped) WARC file.'''
+    for fields, content in read_warc_records(path):
+        if fields.get(b'warc-type') != b'response':
+            continue
+
+        url = fields.get(b'warc-target-uri', b'').decode('utf8', 'replace')
+
+        if is_cdn_url(url) and content.startswith(b'HTTP/') and \
+                content[:64].split(b' ', 2)[1:2] == [b'200']:
+            yield url
+
+
+def main():
+    command = sys.argv[1]
+    output_path = sys.argv[2]
+    input_paths = sys.argv[3:]
+
+    with open(output_path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        update_filter(command, output_path, input_paths)
+
+
+def update_filter(command, output_path, input_paths):
+    if os.path.exists(output_path):
+        bloom_filter = BloomFilter(output_path, writable=True)
+    else:
+        bloom_filter = BloomFilter.create(output_path)
+
+    if command == 'build':
+        for path in input_paths:
+            if not os.path.exists(path):
+                print('Skipping missing {0}.'.format(path))
+                continue
+
+            if '.cdx' in path:
+                urls = read_cdx_urls(path)
+            else:
+                urls = read_warc_urls(path)
+
+            count = 0
+
+            for url in urls:
+                bloom_filter.add(url)
+                count += 1
+
+            print('Added {0} URLs from {1}.'.format(count, path))
+    elif command == 'merge':
+        for path in input_paths:
+            other = BloomFilter(path)
+            bloom_filter.merge(other)
+            other.close()
+            print('Merged {0}.'.format(path))
+    else:
+        raise Exception('Unknown command.')
+
+    bloom_filter.close()
+
+
+if __name__ == '__main__':
+    main()
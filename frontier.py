@@ -0,0 +1,135 @@
+'''Keeps the wpull database of huge items small and its memory bounded.
+
+furaffinity.py switches this on for items with lots of submissions. The
+database then gets pragmas suited to a long crawl on a small disk, and
+finished URLs are moved out of it every now and then: they go into a Bloom
+filter next to the database, which accept_url consults so they are not
+queued again, and their rows are deleted.
+'''
+from __future__ import print_function
+import os
+import sqlite3
+
+import cdnfilter
+
+
+# Below one false positive in a million up to 400,000 URLs
+FILTER_NUM_BITS = 2 ** 24
+
+# furaffinity.py compacts the database after every COMPACT_INTERVAL tries.
+COMPACT_INTERVAL = 2000
+
+COMPACT_CHUNK_SIZE = 5000
+
+
+def pragmas(memory_limit):
+    '''Returns the pragmas for a database that may use `memory_limit` bytes.
+
+    The page cache gets a quarter of the limit; beyond the limit, SQLite
+    spills dirty pages and temporary tables to disk instead of growing.
+    '''
+    return (
+        'PRAGMA journal_mode=WAL',
+        # Safe with WAL; a crash loses at most the last transactions, which
+        # wpull redoes when the item is resumed.
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=-{0}'.format(max(1024, memory_limit // 4 // 1024)),
+        'PRAGMA cache_spill=1',
+        'PRAGMA temp_store=FILE',
+        'PRAGMA mmap_size=0',
+        'PRAGMA soft_heap_limit={0}'.format(memory_limit),
+        # Shrink the write-ahead log back after each checkpoint
+        'PRAGMA journal_size_limit={0}'.format(16 * 1048576),
+    )
+
+
+def tune(connection, memory_limit):
+    '''Applies pragmas() to a DB-API SQLite connection.'''
+    cursor = connection.cursor()
+
+    try:
+        for pragma in pragmas(memory_limit):
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+class FrontierStore(object):
+    '''Compacts a wpull database and remembers the URLs removed from it.'''
+    def __init__(self, db_path, filter_path, memory_limit=64 * 1048576):
+        self.db_path = db_path
+        self.filter_path = filter_path
+        self.memory_limit = memory_limit
+
+        if os.path.exists(filter_path):
+            self.compacted = cdnfilter.BloomFilter(filter_path, writable=True)
+        else:
+            self.compacted = None
+
+    def __contains__(self, url):
+        return self.compacted is not None and url in self.compacted
+
+    def connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=60)
+        tune(connection, self.memory_limit)
+        return connection
+
+    def compact(self):
+        '''Moves the finished URLs out of the database.
+
+        Returns the number of URLs removed. URL strings still used as the
+        referrer or top URL of another URL are kept.
+        '''
+        if self.compacted is None:
+            self.compacted = cdnfilter.BloomFilter.create(self.filter_path, num_bits=FILTER_NUM_BITS)
+
+        connection = self.connect()
+        count = 0
+
+        try:
+            with connection:
+                connection.execute('CREATE TEMP TABLE IF NOT EXISTS compacted (id INTEGER PRIMARY KEY)')
+                connection.execute('DELETE FROM compacted')
+
+                while True:
+                    rows = connection.execute(
+                        'SELECT urls.id, urls.url_str_id, url_strings.url FROM urls '
+                        'JOIN url_strings ON urls.url_str_id = url_strings.id '
+                        'WHERE urls.status = ? LIMIT ?',
+                        ('done', COMPACT_CHUNK_SIZE)
+                    ).fetchall()
+
+                    if not rows:
+                        break
+
+                    for dummy, dummy, url in rows:
+                        self.compacted.add(url)
+
+                    connection.executemany(
+                        'INSERT OR IGNORE INTO compacted (id) VALUES (?)',
+                        ((url_str_id,) for dummy, url_str_id, dummy in rows))
+                    connection.executemany(
+                        'DELETE FROM urls WHERE id = ?',
+                        ((url_id,) for url_id, dummy, dummy in rows))
+                    count += len(rows)
+
+                connection.execute(
+                    'DELETE FROM url_strings WHERE id IN (SELECT id FROM compacted) '
+                    'AND id NOT IN (SELECT referrer_id FROM urls WHERE referrer_id IS NOT NULL) '
+                    'AND id NOT IN (SELECT top_url_str_id FROM urls WHERE top_url_str_id IS NOT NULL)'
+                )
+                connection.execute('DROP TABLE compacted')
+
+                # The URLs must be in the filter on disk before their rows
+                # are gone.
+                self.compacted.flush()
+
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            connection.close()
+
+        return count
+
+    def close(self):
+        if self.compacted is not None:
+            self.compacted.close()
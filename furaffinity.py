@@ -1,5 +1,10 @@
 import codecs
+import collections
+import heapq
+import json
 import os
+import random
+import sqlite3
 import sys
 import time
 import re
@@ -12,7 +17,131 @@ max_scraps_page = None
 max_favorites_page = None
 item_dir = os.environ['item_dir']
 lots_of_submissions = False
+listing_counts = {}
 item_name = os.environ['item_name']
+# Tracker items downloaded by this process
+item_names = (os.environ.get('batch_item_names') or item_name).split(',')
+batch_size = len(item_names)
+
+PAGINATION_RE = re.compile(r'furaffinity\.net/(\w+)/([^/]+)/(\d+)/')
+PROFILE_RE = re.compile(r'^https?://www\.furaffinity\.net/user/([^/]+)/$')
+LISTING_RE = re.compile(r'^https?://www\.furaffinity\.net/(gallery|scraps|favorites)/([^/]+)/$')
+RANGE_SEED_RE = re.compile(r'^https?://www\.furaffinity\.net/(view|journal)/(\d+)/$')
+
+# Smallest number of thumbnails FA puts on a gallery, scraps or favorites
+# page, used by the cost estimate until the first gallery page is seen.
+LISTING_PAGE_SIZE = 24
+MAX_FAVORITES_PAGE = 500
+
+# URLs matching any of these are never fetched. The rules are compiled into
+# URLFilter below; hits per rule are reported in url_filter_stats.json.
+URL_REJECT_RULES = (
+    ('classic_theme', r'/themes/classic/'),
+    ('google_analytics', r'google-analytics\.com|google\.com/analytics|gstatic\.com/analytics'),
+    ('commission_forms', r'/commissions/.*/(?:add|manage)/$'),
+    # ArchiveTeam is banned from stupid puush
+    ('puush', r'puu\.sh/'),
+    ('google_ads', r'googleadservices\.com|googlesyndication\.com/pagead/|googletagservices\.com'),
+    ('facdn_root', r'//d\.facdn\.net/(?:art/)?$'),
+    ('facdn_art_directory', r'^https?://d\.facdn\.net/art/.*/$'),
+    ('zekromlover_gif', r'^http://d\.facdn\.net/art/zekromlover/1398041825\.zekromlover_fuleco-300x300_1_\.gif$'),
+    ('zoovy', r'static\.zoovy\.com'),
+)
+
+# Extra rules that only apply to a single problematic item. In a batch they
+# only apply to the URLs found from the seeds of that item.
+ITEM_URL_REJECT_RULES = {
+    'journal:5259901-5259950': (
+        ('journal_5259901_gifs', r'^https?://a\.facdn\.net/.*\.gif$'),
+    ),
+}
+
+
+class URLFilter(object):
+    def __init__(self, rules):
+        # Named groups make the combined pattern several times slower, so the
+        # fast patterns are anonymous and the (rare) hits are attributed to
+        # their rule afterwards. Anchored rules only need to be tried at the
+        # start of the URL.
+        self.rules = [(name, re.compile(pattern)) for name, pattern in rules]
+        self.anchored_re = re.compile('|'.join(
+            '(?:{0})'.format(pattern[1:]) for name, pattern in rules if pattern.startswith('^')
+        ) or '(?!)')
+        self.floating_re = re.compile('|'.join(
+            '(?:{0})'.format(pattern) for name, pattern in rules if not pattern.startswith('^')
+        ) or '(?!)')
+
+    def match(self, url):
+        if not self.anchored_re.match(url) and not self.floating_re.search(url):
+            return None
+
+        for name, pattern in self.rules:
+            if pattern.search(url):
+                return name
+
+
+if batch_size > 1:
+    url_filter = URLFilter(URL_REJECT_RULES)
+    item_url_filters = dict(
+        (name, URLFilter(ITEM_URL_REJECT_RULES[name]))
+        for name in item_names if name in ITEM_URL_REJECT_RULES)
+else:
+    url_filter = URLFilter(URL_REJECT_RULES + ITEM_URL_REJECT_RULES.get(item_name, ()))
+    item_url_filters = {}
+
+
+def batch_item_name(top_url):
+    '''Returns the name of the batched item that has `top_url` as a seed.'''
+    match = RANGE_SEED_RE.match(top_url)
+
+    if not match:
+        return None
+
+    seed_type = 'submission' if match.group(1) == 'view' else 'journal'
+    num = int(match.group(2))
+
+    for name in item_names:
+        name_type, dummy, bounds = name.partition(':')
+        start_num, dummy, end_num = bounds.partition('-')
+
+        if name_type == seed_type and int(start_num) <= num <= int(end_num):
+            return name
+
+
+# The batched item each accepted URL was first found under, and the URLs
+# found under several, which split_batch_warc copies to each of them
+batch_url_items = {}
+shared_urls = collections.defaultdict(set)
+
+
+def note_batch_url(url, record_info):
+    name = batch_item_name(record_info.get('top_url') or record_info['url'])
+
+    if name is not None and batch_url_items.setdefault(url, name) != name:
+        shared_urls[url].update((batch_url_items[url], name))
+
+
+def write_shared_urls():
+    with open(os.path.join(item_dir, 'shared_urls.json'), 'w') as file:
+        json.dump(dict((url, sorted(names)) for url, names in shared_urls.items()), file)
+
+# Wpull runs this script from the pipeline directory
+sys.path.insert(0, os.getcwd())
+import cdnfilter
+import frontier
+
+if os.environ.get('cdn_filter') and os.path.exists(os.environ['cdn_filter']):
+    cdn_filter = cdnfilter.BloomFilter(os.environ['cdn_filter'])
+else:
+    cdn_filter = None
+
+frontier_store = frontier.FrontierStore(
+    os.path.join(item_dir, 'wpull.db'), os.path.join(item_dir, 'frontier.bloom'),
+    memory_limit=int(os.environ.get('frontier_memory') or 64) * 1048576)
+frontier_tuned = False
+
+url_filter_hits = collections.Counter()
+url_filter_stats = {'calls': 0, 'seconds': 0.0}
 
 
 def print_(*args, **kwargs):
@@ -20,19 +149,423 @@ def print_(*args, **kwargs):
     sys.stdout.flush()
 
 
+class UsernameCollector(object):
+    '''Deduplicates scraped usernames and appends the new ones of a page.
+
+    The names are written once per page rather than held back for more,
+    as a page is not fetched again on resume and its names would be lost.
+    '''
+    def __init__(self, path, max_seen=100000):
+        self.path = path
+        self.max_seen = max_seen
+        self.seen = set()
+        self.pending = []
+
+    def add(self, usernames):
+        for username in usernames:
+            username = username.strip().lower()
+
+            if username and username not in self.seen:
+                if len(self.seen) >= self.max_seen:
+                    # The file has them all and helper.py deduplicates
+                    # them again, so forgetting only costs a few repeats.
+                    self.seen.clear()
+
+                self.seen.add(username)
+                self.pending.append(username)
+
+        self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        with open(self.path, 'a', encoding='utf8', errors='replace') as file:
+            file.write(''.join(username + '\n' for username in self.pending))
+
+        self.pending = []
+
+
+username_collector = UsernameCollector(os.path.join(item_dir, 'usernames.txt'))
+
+
+class RateController(object):
+    '''Adapts the delay between requests to how well the site is coping.
+
+    The delay of a host class shrinks by a small step after each fast, good
+    response and is multiplied after errors, slow responses or problem
+    pages. The delays are kept in a file so that all wpull processes on
+    this node (and IP) share what they learn. `min_delay` is a floor for
+    this process only and is not shared.
+    '''
+    # host class: (minimum, maximum, initial delay, step, slow response)
+    SETTINGS = {
+        'pages': (0.25, 60.0, 1.0, 0.05, 5.0),
+        'cdn': (0.0, 30.0, 0.0, 0.1, 10.0),
+    }
+    BACKOFF_FACTOR = 2.0
+    SAVE_INTERVAL = 10.0
+
+    def __init__(self, path, min_delay=0.0):
+        self.path = path
+        self.min_delay = min_delay
+        self.delays = dict((name, settings[2]) for name, settings in self.SETTINGS.items())
+        self._loaded_mtime = None
+        self._last_save = 0.0
+        self.load()
+
+    @staticmethod
+    def host_class(hostname):
+        if 'facdn.net' in hostname:
+            return 'cdn'
+        elif 'furaffinity.net' in hostname:
+            return 'pages'
+
+    def load(self):
+        if not self.path:
+            return
+
+        try:
+            mtime = os.path.getmtime(self.path)
+
+            if mtime == self._loaded_mtime:
+                return
+
+            with open(self.path, 'r') as file:
+                self.delays.update(json.load(file))
+        except (OSError, ValueError):
+            return
+
+        self._loaded_mtime = mtime
+
+    def save(self):
+        self._last_save = time.time()
+
+        if not self.path:
+            return
+
+        temp_path = '{0}.{1}'.format(self.path, os.getpid())
+
+        with open(temp_path, 'w') as file:
+            json.dump(self.delays, file)
+
+        os.replace(temp_path, self.path)
+        self._loaded_mtime = os.path.getmtime(self.path)
+
+    def delay(self, host_class):
+        self.load()
+        return self.delays[host_class]
+
+    def record_success(self, host_class, latency):
+        minimum, maximum, initial, step, slow = self.SETTINGS[host_class]
+
+        if latency is not None and latency > slow:
+            self.record_problem(host_class)
+            return
+
+        self.load()
+        self.delays[host_class] = max(minimum, self.delays[host_class] - step)
+
+        if time.time() - self._last_save > self.SAVE_INTERVAL:
+            self.save()
+
+    def record_problem(self, host_class):
+        minimum, maximum, initial, step, slow = self.SETTINGS[host_class]
+
+        self.load()
+        delay = max(self.delays[host_class], step, minimum) * self.BACKOFF_FACTOR
+        self.delays[host_class] = min(maximum, delay)
+        print_('Slowing down {0} requests to one per {1:.2f} seconds.'.format(
+            host_class, self.delays[host_class]))
+        self.save()
+
+
+rate_controller = RateController(
+    os.environ.get('rate_file'), min_delay=float(os.environ.get('min_wait') or 0))
+
+
+class CircuitBreaker(object):
+    '''Tracks failing hosts so only they are cooled down.
+
+    A failure opens the circuit of a host for `cooldown` seconds; until
+    then accept_url puts the URLs of that host back in the queue while the
+    other hosts carry on. Afterwards the circuit is half-open: a success
+    closes it, another failure opens it again with twice the cooldown.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, cooldown=60.0, max_cooldown=600.0):
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.hosts = {}
+
+    def state(self, hostname):
+        host = self.hosts.get(hostname)
+
+        if not host:
+            return self.CLOSED
+
+        if host['state'] == self.OPEN and time.time() >= host['until']:
+            host['state'] = self.HALF_OPEN
+
+        return host['state']
+
+    def remaining(self, hostname):
+        if self.state(hostname) != self.OPEN:
+            return 0
+
+        return self.hosts[hostname]['until'] - time.time()
+
+    def record_failure(self, hostname):
+        if self.state(hostname) == self.HALF_OPEN:
+            cooldown = min(self.max_cooldown, self.hosts[hostname]['cooldown'] * 2)
+        else:
+            cooldown = self.cooldown
+
+        self.hosts[hostname] = {
+            'state': self.OPEN,
+            'until': time.time() + cooldown,
+            'cooldown': cooldown,
+        }
+
+        return cooldown
+
+    def record_success(self, hostname):
+        self.hosts.pop(hostname, None)
+
+
+circuit_breaker = CircuitBreaker()
+# URLs put back because the circuit of their host was open, by hostname
+deferred_urls = collections.defaultdict(list)
+request_start_time = None
+response_latency = None
+
+
+class CostEstimate(object):
+    '''Predicts how big a profile item is from its first pages.
+
+    The userpage statistics give the number of submissions and favorites,
+    and the first gallery page how many thumbnails a listing page holds.
+    The estimate sets the tries budget of the item, so big profiles are
+    not cut off by a cap meant for small ones, and is kept in
+    cost_estimate.json, where the pipeline and a resumed attempt find it.
+    '''
+    # The view page, the file and the thumbnail
+    URLS_PER_SUBMISSION = 3
+    BYTES_PER_SUBMISSION = 1000000
+    BYTES_PER_PAGE = 40000
+    # Userpage, commissions, journals and shared page requisites
+    BASE_URLS = 100
+    # Room for retries and URLs the estimate doesn't know about
+    TRIES_PER_URL = 2
+    MIN_TRIES = 5000
+
+    def __init__(self, path):
+        self.path = path
+        self.counts = {}
+        self.page_size = LISTING_PAGE_SIZE
+        self.estimate = None
+
+        if os.path.exists(path):
+            with open(path) as file:
+                self.estimate = json.load(file)
+
+            self.counts = self.estimate['counts']
+            self.page_size = self.estimate['page_size']
+
+    def update(self, counts=None, page_size=None):
+        if counts:
+            self.counts = counts
+
+        if page_size:
+            self.page_size = max(LISTING_PAGE_SIZE, page_size)
+
+        if not self.counts:
+            return
+
+        submissions = self.counts.get('submissions', 0)
+        favorites = self.counts.get('favorites', 0)
+        # The gallery and the scraps share the submission count.
+        listing_pages = 2 + submissions // self.page_size + \
+            min(MAX_FAVORITES_PAGE, 1 + favorites // self.page_size)
+        pages = self.BASE_URLS + listing_pages + submissions
+        urls = self.BASE_URLS + listing_pages + submissions * self.URLS_PER_SUBMISSION
+
+        self.estimate = {
+            'counts': self.counts,
+            'page_size': self.page_size,
+            'urls': urls,
+            'bytes': submissions * self.BYTES_PER_SUBMISSION + pages * self.BYTES_PER_PAGE,
+            'tries_budget': max(self.MIN_TRIES, urls * self.TRIES_PER_URL),
+        }
+
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(self.estimate, file, sort_keys=True)
+
+        os.rename(self.path + '.tmp', self.path)
+        print_('Estimated {urls} URLs and {bytes} bytes; allowing {tries_budget} tries.'.format(
+            **self.estimate))
+
+    @property
+    def tries_budget(self):
+        return self.estimate and self.estimate['tries_budget']
+
+
+cost_estimate = CostEstimate(os.path.join(item_dir, 'cost_estimate.json'))
+
+
+class HookProfiler(object):
+    '''Times the wpull callbacks of this script.
+
+    Keeps call counts, total and per-call times, a histogram of call times
+    and the slowest URLs per callback, and writes them to
+    hook_profile.json in the item directory. With `use_cprofile`, the
+    callbacks also run under cProfile and the stats go to
+    hook_profile.pstats.
+    '''
+    # Upper bounds of the histogram buckets, in seconds
+    BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, float('inf'))
+    NUM_SLOWEST = 20
+
+    def __init__(self, path, use_cprofile=False):
+        self.path = path
+        self.start_time = time.time()
+        self.calls = {}
+
+        if use_cprofile:
+            import cProfile
+            self.profile = cProfile.Profile()
+        else:
+            self.profile = None
+
+    def install(self, callbacks, names):
+        for name in names:
+            setattr(callbacks, name, self.wrap(name, getattr(callbacks, name)))
+
+    def wrap(self, name, func):
+        stats = self.calls[name] = {
+            'count': 0,
+            'seconds': 0.0,
+            'max_seconds': 0.0,
+            'histogram': [0] * len(self.BUCKETS),
+            'slowest': [],
+        }
+        profile = self.profile
+
+        def wrapper(*args):
+            if profile:
+                profile.enable()
+
+            started = time.perf_counter()
+
+            try:
+                return func(*args)
+            finally:
+                duration = time.perf_counter() - started
+
+                if profile:
+                    profile.disable()
+
+                stats['count'] += 1
+                stats['seconds'] += duration
+                stats['max_seconds'] = max(stats['max_seconds'], duration)
+
+                for index, bound in enumerate(self.BUCKETS):
+                    if duration < bound:
+                        stats['histogram'][index] += 1
+                        break
+
+                slowest = stats['slowest']
+
+                if len(slowest) < self.NUM_SLOWEST or duration > slowest[0][0]:
+                    url = next((arg['url'] for arg in args if isinstance(arg, dict) and 'url' in arg), None)
+                    entry = (duration, stats['count'], url)
+
+                    if len(slowest) < self.NUM_SLOWEST:
+                        heapq.heappush(slowest, entry)
+                    else:
+                        heapq.heapreplace(slowest, entry)
+
+        return wrapper
+
+    def dump(self):
+        elapsed = time.time() - self.start_time
+        hook_seconds = sum(stats['seconds'] for stats in self.calls.values())
+        summary = {
+            'elapsed_seconds': elapsed,
+            'hook_seconds': hook_seconds,
+            'hook_share': hook_seconds / elapsed if elapsed else 0.0,
+            'histogram_buckets': [str(bound) for bound in self.BUCKETS],
+            'callbacks': {},
+        }
+
+        for name, stats in self.calls.items():
+            summary['callbacks'][name] = {
+                'count': stats['count'],
+                'seconds': stats['seconds'],
+                'mean_seconds': stats['seconds'] / stats['count'] if stats['count'] else 0.0,
+                'max_seconds': stats['max_seconds'],
+                'histogram': stats['histogram'],
+                'slowest': [
+                    {'seconds': duration, 'url': url}
+                    for duration, dummy, url in sorted(stats['slowest'], reverse=True)
+                ],
+            }
+
+        with open(os.path.join(self.path, 'hook_profile.json'), 'w') as file:
+            json.dump(summary, file, indent=2, sort_keys=True)
+
+        if self.profile:
+            self.profile.dump_stats(os.path.join(self.path, 'hook_profile.pstats'))
+
+        print_('Hooks took {0:.1f}s of {1:.1f}s ({2:.1%}).'.format(
+            hook_seconds, elapsed, summary['hook_share']))
+
+
+if os.environ.get('hook_profile'):
+    hook_profiler = HookProfiler(item_dir, use_cprofile=os.environ['hook_profile'] == 'cprofile')
+else:
+    hook_profiler = None
+
+
 def engine_run():
     with open(os.path.join(item_dir, 'usernames.txt'), 'a'):
         pass
 
 
 def accept_url(url_info, record_info, verdict, reasons):
-    global max_gallery_page
-    global max_scraps_page
+    start_time = time.perf_counter()
+    url_filter_stats['calls'] += 1
+
+    try:
+        verdict = check_url(url_info['url'], record_info, verdict)
+
+        # Only when wpull is about to fetch the URL, not when it is found
+        if verdict and record_info.get('status') == 'in_progress' and \
+                circuit_breaker.state(url_info['hostname']) == CircuitBreaker.OPEN:
+            return not defer_url(url_info['hostname'], record_info['url'])
+
+        if verdict and batch_size > 1:
+            note_batch_url(url_info['url'], record_info)
+
+        return verdict
+    finally:
+        url_filter_stats['seconds'] += time.perf_counter() - start_time
 
-    url = url_info['url']
+
+def check_url(url, record_info, verdict):
+    if url in frontier_store:
+        url_filter_hits['compacted'] += 1
+        return False
+
+    if cdn_filter is not None and 'facdn.net' in url and url in cdn_filter:
+        url_filter_hits['cdn_filter'] += 1
+        return False
 
     if verdict:
-        match = re.search(r'furaffinity\.net/(\w+)/([^/]+)/(\d+)/', url)
+        match = PAGINATION_RE.search(url)
 
         if match:
             what_type = match.group(1).lower()
@@ -43,92 +576,94 @@ def accept_url(url_info, record_info, verdict, reasons):
                 if what_type == 'gallery':
                     if max_gallery_page is not None and num > max_gallery_page:
                         print_('Pagination complete for gallery')
+                        url_filter_hits['gallery_pagination'] += 1
                         return False
                 elif what_type == 'scraps':
                     if max_scraps_page is not None and num > max_scraps_page:
                         print_('Pagination complete for scraps')
+                        url_filter_hits['scraps_pagination'] += 1
                         return False
                 elif what_type == 'favorites':
                     if max_favorites_page is not None and num > max_favorites_page:
                         print_('Pagination complete for favorites')
+                        url_filter_hits['favorites_pagination'] += 1
                         return False
-                    elif num > 500:
+                    elif num > MAX_FAVORITES_PAGE:
                         print_('Wow, this user likes a lot of things! Capped the pagination.')
+                        url_filter_hits['favorites_cap'] += 1
                         return False
                 else:
                     raise Exception('Unknown what type!')
 
-        if '/themes/classic/' in url:
-            return False
-        if 'google-analytics.com' in url:
-            return False
-        if 'google.com/analytics' in url:
-            return False
-        if 'gstatic.com/analytics' in url:
-            return False
-        if re.search(r'/commissions/.*/(add|manage)/$', url_info['url']):
-            return False
-
-        if 'facdn.net' in url and 'furaffinity.net/favorites/' in record_info['referrer']:
-            return False
-
-        if 'puu.sh/' in url:
-            # ArchiveTeam is banned from stupid puush
-            return False
+        rule_name = url_filter.match(url)
 
-        if 'googleadservices.com' in url:
-            return False
-        if 'googlesyndication.com/pagead/' in url:
-            return False
-        if 'googletagservices.com' in url:
-            return False
+        if not rule_name and item_url_filters:
+            name = batch_item_name(record_info.get('top_url') or record_info['url'])
 
-        if url.endswith('//d.facdn.net/art/') or url.endswith('//d.facdn.net/'):
-            return False
-
-        if re.match(r'^https?://d\.facdn\.net/art/.*/$', url):
-            return False
+            if name in item_url_filters:
+                rule_name = item_url_filters[name].match(url)
 
-        if url == 'http://d.facdn.net/art/zekromlover/1398041825.zekromlover_fuleco-300x300_1_.gif':
+        if rule_name:
+            url_filter_hits[rule_name] += 1
             return False
 
-        if item_name == 'journal:5259901-5259950' and re.match(r'https?://a\.facdn\.net/.*\.gif$', url):
-            return False
-
-        if 'static.zoovy.com' in url:
+        if 'facdn.net' in url and 'furaffinity.net/favorites/' in record_info['referrer']:
+            url_filter_hits['favorites_thumbnails'] += 1
             return False
 
     if not verdict and 'facdn.net' in url and 'furaffinity.net/view/' in record_info['referrer'] \
             and not url.endswith('//d.facdn.net/art/') and not url.endswith('//d.facdn.net/'):
+        url_filter_hits['view_requisites'] += 1
         return True
 
     return verdict
 
 
 def handle_pre_response(url_info, record_info, response_info):
+    global response_latency
+
+    if request_start_time is not None:
+        response_latency = time.time() - request_start_time
+    else:
+        response_latency = None
+
     return wpull_hook.actions.NORMAL
 
 
+def tries_budget():
+    if lots_of_submissions:
+        budget = 10000 * batch_size
+    else:
+        budget = 5000 * batch_size
+
+    return max(budget, cost_estimate.tries_budget or 0)
+
+
 def handle_response(url_info, record_info, response_info):
     global tries
     global total_tries
     total_tries += 1
 
-    max_tries = 5000
-    if lots_of_submissions:
-        max_tries = 10000
-
-    if total_tries > max_tries:
+    if total_tries > tries_budget():
         raise Exception('Too many tries in this session!')
 
+    maintain_frontier()
+
     status_code = response_info['status_code']
     url = url_info['url']
     hostname = url_info['hostname']
+    host_class = rate_controller.host_class(hostname)
+
+    if host_class:
+        if status_code == 429 or status_code >= 500:
+            rate_controller.record_problem(host_class)
+        elif status_code < 400 or status_code in (404, 410):
+            rate_controller.record_success(host_class, response_latency)
 
     if status_code not in (404, 410) and status_code >= 400:
-        if 'furaffinity.net' in hostname or 'facdn.net' in hostname:
-            print_('Uh oh!. Sleeping...')
-            time.sleep(60)
+        if host_class:
+            cooldown = circuit_breaker.record_failure(hostname)
+            print_('Uh oh! Cooling down {0} for {1:.0f} seconds...'.format(hostname, cooldown))
 
         tries += 1
 
@@ -140,7 +675,7 @@ def handle_response(url_info, record_info, response_info):
             return wpull_hook.actions.RETRY
 
     tries = 0
-
+    circuit_breaker.record_success(hostname)
 
     return wpull_hook.actions.NORMAL
 
@@ -150,15 +685,17 @@ def handle_error(url_info, record_info, error_info):
     global total_tries
     total_tries += 1
 
-    max_tries = 5000
-    if lots_of_submissions:
-        max_tries = 10000
-
-    if total_tries > max_tries:
+    if total_tries > tries_budget():
         raise Exception('Too many tries in this session!')
 
     tries += 1
     url = url_info['url']
+    host_class = rate_controller.host_class(url_info['hostname'])
+
+    if host_class:
+        rate_controller.record_problem(host_class)
+        circuit_breaker.record_failure(url_info['hostname'])
+
     if tries >= 5 and ('furaffinity.net' in url or 'facdn.net' in url):
         raise Exception('Giving up')
     elif tries >= 5:
@@ -171,117 +708,172 @@ def get_urls(filename, url_info, document_info):
     urls = []
 
     if 'furaffinity.net' in url_info['hostname']:
-        with open(filename, 'r', encoding='utf8', errors='replace') as file:
-            text = file.read(1048576)
+        with open(filename, 'rb') as file:
+            page = PageAnalysis(file.read(1048576))
 
-        check_ok_content(text)
+        check_ok_content(page)
 
-        if not is_text_404(text):
-            with open(os.path.join(item_dir, 'usernames.txt'), 'a', encoding='utf8', errors='replace') as file:
-                for username in scrape_usernames(text):
-                    file.write(username)
-                    file.write('\n')
+        if not page.is_404:
+            username_collector.add(page.usernames)
 
             url = url_info['url']
-            check_pagination(text, url)
+            check_pagination(page, url)
+            estimate_cost(page, url)
+            urls.extend(plan_pagination(page, url))
 
             if re.match(r'^https?://(www\.)?furaffinity\.net/view/\d+', url):
-                check_full_view(text)
+                check_full_view(page)
 
         print_('Looking good so far..')
 
-        match = re.search(r'<a href="([^"]+)">Download</a>', text)
+        download_url = page.download_url
 
-        if match:
+        if download_url:
             urls.append({
-                'url': match.group(1)
+                'url': download_url
             })
 
     return urls
 
 
-def check_ok_content(text):
-    ok_text_found = (
-        'Commission Info</a>' in text or
-        '<b>Submission information:' in text or
-        'This user cannot be found.' in text or
-        'The journal you are trying to find is not in our database.' in text or
-        'The submission you are trying to find is not in our database.' in text
-    )
-
-    is_404_error_page = is_text_404(text)
-
-    if ok_text_found and not is_404_error_page and '/logout/' not in text:
-        print_('Problem detected. Not logged in! Sleeping.')
-        time.sleep(60)
+class PageAnalysis(object):
+    '''Everything the hooks want to know about a furaffinity.net page.
+
+    Works on the raw bytes so the page never has to be decoded as a whole.
+    Each marker is searched for at most once, and only when asked for.
+    '''
+    USERNAME_RE = re.compile(rb'href="/user/([^"]+)"')
+    STATISTIC_RE = re.compile(rb'<b>(Submissions|Favs|Favorites):</b>\s*([\d,]+)')
+
+    def __init__(self, data):
+        self.data = data
+        self._markers = {}
+
+    def has(self, marker):
+        try:
+            return self._markers[marker]
+        except KeyError:
+            found = self._markers[marker] = marker in self.data
+            return found
+
+    @property
+    def is_ok(self):
+        return (
+            self.has(b'Commission Info</a>') or
+            self.has(b'<b>Submission information:') or
+            self.has(b'This user cannot be found.') or
+            self.has(b'The journal you are trying to find is not in our database.') or
+            self.has(b'The submission you are trying to find is not in our database.')
+        )
+
+    @property
+    def is_404(self):
+        return (
+            self.has(b'This user cannot be found.') or
+            self.has(b'This user has voluntarily disabled access to their userpage.') or
+            self.has(b'The journal you are trying to find is not in our database.') or
+            self.has(b'The submission you are trying to find is not in our database.')
+        )
+
+    @property
+    def is_logged_in(self):
+        return self.has(b'/logout/')
+
+    @property
+    def can_view_adult(self):
+        return self.has(b'Toggle to hide Mature and Adult submissions.')
+
+    @property
+    def is_pagination_empty(self):
+        return self.has(b'There are no submissions to list')
+
+    @property
+    def is_full_view(self):
+        if self.has(b' type="application/x-shockwave-flash"') and \
+                (self.has(b'">Download</a>') or self.has(b'">Download </a>')):
+            if self.has(b'facdn.net/art/'):
+                return True
+
+            if self.has(b'//d.facdn.netswf/'):
+                # Website can't even URL properly
+                return True
+
+        return self.has(b'var is_full = 1;')
+
+    @property
+    def usernames(self):
+        names = self.USERNAME_RE.findall(self.data)
+
+        if not names:
+            return []
+
+        # Decode all of them in one go; a quote can't be part of a name.
+        return [name.strip('/') for name in b'"'.join(names).decode('utf8', 'replace').split('"')]
+
+    @property
+    def statistics(self):
+        '''The submission and favorite counts shown on a userpage.'''
+        counts = {}
+
+        for name, value in self.STATISTIC_RE.findall(self.data):
+            name = 'submissions' if name == b'Submissions' else 'favorites'
+            counts[name] = int(value.replace(b',', b''))
+
+        return counts
+
+    @property
+    def thumbnail_count(self):
+        return self.data.count(b'id="sid-') + self.data.count(b'id="sid_')
+
+    @property
+    def download_url(self):
+        # Same as searching for '<a href="([^"]+)">Download</a>', but starts
+        # from the rare link text instead of trying every link on the page.
+        data = self.data
+        end = data.find(b'">Download</a>')
+
+        while end != -1:
+            quote = data.rfind(b'"', 0, end)
+
+            if quote + 1 < end and data[quote - 8:quote + 1] == b'<a href="':
+                return data[quote + 1:end].decode('utf8', 'replace')
+
+            end = data.find(b'">Download</a>', end + 1)
+
+
+def check_ok_content(page):
+    if page.is_ok and not page.is_404 and not page.is_logged_in:
+        print_('Problem detected. Not logged in!')
+        rate_controller.record_problem('pages')
         raise Exception('Not logged in!')
-    elif ok_text_found and not is_404_error_page and 'Toggle to hide Mature and Adult submissions.' not in text:
-        print_('Problem detected. Cannot view adult material! Sleeping.')
-        time.sleep(60)
+    elif page.is_ok and not page.is_404 and not page.can_view_adult:
+        print_('Problem detected. Cannot view adult material!')
+        rate_controller.record_problem('pages')
         raise Exception('Cannot view adult material!')
 
 
-def check_full_view(text):
-    if ' type="application/x-shockwave-flash"' in text and \
-            'facdn.net/art/' in text and \
-            ('">Download</a>' in text or '">Download </a>' in text):
-        return
-
-    if ' type="application/x-shockwave-flash"' in text and \
-            '//d.facdn.netswf/' in text and \
-            ('">Download</a>' in text or '">Download </a>' in text):
-        # Website can't even URL properly
-        return
-
-    if 'var is_full = 1;' not in text:
+def check_full_view(page):
+    if not page.is_full_view:
         raise Exception('Full view not found!')
 
 
-def is_text_404(text):
-    is_404_error_page = (
-        'This user cannot be found.' in text or
-        'This user has voluntarily disabled access to their userpage.' in text or
-        'The journal you are trying to find is not in our database.' in text or
-        'The submission you are trying to find is not in our database.' in text
-    )
-    return is_404_error_page
-
-
-def scrape_usernames(text):
-    for match in re.finditer(r'href="/user/([^"]+)"', text):
-        username = match.group(1)
-        username = username.strip('/')
-        yield username
-
-
-def check_pagination(text, url):
-    global max_gallery_page
-    global max_scraps_page
-    global max_favorites_page
+def check_pagination(page, url):
     global lots_of_submissions
 
-    match = re.search(r'furaffinity\.net/(\w+)/([^/]+)/(\d+)/', url)
+    match = PAGINATION_RE.search(url)
 
     if match:
-        # if codecs.encode('kzyuggc_znxrf_gebtqbe_fnq', 'rot_13') not in text:
+        # if codecs.encode('kzyuggc_znxrf_gebtqbe_fnq', 'rot_13').encode('ascii') not in page.data:
         #     raise Exception('Could not find pagination form!')
 
         what_type = match.group(1).lower()
 
-        if what_type in ('gallery', 'scraps', 'favorites') and 'There are no submissions to list' in text:
+        if what_type in ('gallery', 'scraps', 'favorites') and page.is_pagination_empty:
             num = int(match.group(3))
 
-            if what_type == 'gallery':
-                if max_gallery_page is None:
-                    max_gallery_page = num
-            elif what_type == 'scraps':
-                if max_scraps_page is None:
-                    max_scraps_page = num
-            elif what_type == 'favorites':
-                if max_favorites_page is None:
-                    max_favorites_page = num
-            else:
-                raise Exception('Unknown what type!')
+            limit_pagination(what_type, num)
+        elif what_type == 'favorites' and int(match.group(3)) == MAX_FAVORITES_PAGE:
+            prune_pagination(what_type, MAX_FAVORITES_PAGE)
 
         if what_type in ('gallery', 'scraps'):
             num = int(match.group(3))
@@ -289,11 +881,300 @@ def check_pagination(text, url):
                 lots_of_submissions = True
 
 
-def wait_time(seconds, url_info, url_record, response, error):
-    if 'facdn.net' in url_info['hostname'] and not error:
+def estimate_cost(page, url):
+    if PROFILE_RE.match(url):
+        cost_estimate.update(counts=page.statistics)
+        return
+
+    match = LISTING_RE.match(url)
+
+    if match and match.group(1) == 'gallery':
+        cost_estimate.update(page_size=page.thumbnail_count)
+
+
+def limit_pagination(what_type, max_page):
+    '''Lowers the last page of a listing and drops the queued pages past it.'''
+    global max_gallery_page
+    global max_scraps_page
+    global max_favorites_page
+
+    if what_type == 'gallery':
+        if max_gallery_page is not None and max_gallery_page <= max_page:
+            return
+        max_gallery_page = max_page
+    elif what_type == 'scraps':
+        if max_scraps_page is not None and max_scraps_page <= max_page:
+            return
+        max_scraps_page = max_page
+    elif what_type == 'favorites':
+        if max_favorites_page is not None and max_favorites_page <= max_page:
+            return
+        max_favorites_page = max_page
+    else:
+        raise Exception('Unknown what type!')
+
+    prune_pagination(what_type, max_page)
+
+
+def plan_pagination(page, url):
+    '''Queues every listing page of a profile at once.
+
+    The submission and favorite counts on the userpage are only a hint:
+    they can be stale or hidden, so a listing still ends only at an empty
+    page and pages past the estimate are followed from the pagination
+    links as before. The gallery is sized from the submission count and
+    the favorites from the favorite count; the scraps have no count of
+    their own and are discovered a page at a time. The page size is the
+    number of thumbnails on the first page of the listing, and nothing is
+    queued when that page is already empty. The pages are queued from the
+    first page of each listing so they pass --no-parent.
+    '''
+    match = PROFILE_RE.match(url)
+
+    if match:
+        counts = page.statistics
+
+        for what_type, count_name in (('gallery', 'submissions'),
+                                      ('favorites', 'favorites')):
+            if count_name in counts:
+                listing_counts[what_type] = counts[count_name]
+
+        return []
+
+    match = LISTING_RE.match(url)
+
+    if not match or match.group(1) not in listing_counts:
+        return []
+
+    what_type, username = match.groups()
+    count = listing_counts.pop(what_type)
+    page_size = page.thumbnail_count
+
+    if page.is_pagination_empty or not page_size:
+        return []
+
+    num_pages = (count + page_size - 1) // page_size
+
+    if what_type == 'favorites':
+        num_pages = min(num_pages, MAX_FAVORITES_PAGE)
+
+    if num_pages < 2:
+        return []
+
+    print_('Queueing {0} {1} pages from the profile statistics.'.format(num_pages - 1, what_type))
+
+    return [
+        {'url': 'https://www.furaffinity.net/{0}/{1}/{2}/'.format(what_type, username, num)}
+        for num in range(2, num_pages + 1)
+    ]
+
+
+def prune_pagination(what_type, max_page):
+    '''Skips the queued listing pages past max_page in one go.
+
+    Otherwise they are only dropped one by one by accept_url as wpull gets
+    to them.
+    '''
+    try:
+        db = sqlite3.connect(os.path.join(item_dir, 'wpull.db'), timeout=60)
+
+        try:
+            rows = db.execute(
+                'SELECT urls.id, url_strings.url FROM urls '
+                'JOIN url_strings ON urls.url_str_id = url_strings.id '
+                'WHERE urls.status = ? AND url_strings.url LIKE ?',
+                ('todo', '%furaffinity.net/{0}/%'.format(what_type))
+            ).fetchall()
+            url_ids = []
+
+            for url_id, url in rows:
+                match = PAGINATION_RE.search(url)
+
+                if match and match.group(1).lower() == what_type and int(match.group(3)) > max_page:
+                    url_ids.append((url_id,))
+
+            with db:
+                db.executemany(
+                    'UPDATE urls SET status = ? WHERE id = ? AND status = ?',
+                    (('skipped', url_id, 'todo') for url_id, in url_ids)
+                )
+        finally:
+            db.close()
+    except sqlite3.Error as error:
+        print_('Could not prune {0} pages: {1}'.format(what_type, error))
+        return
+
+    if url_ids:
+        print_('Skipped {0} queued {1} pages past page {2}.'.format(len(url_ids), what_type, max_page))
+        url_filter_hits['{0}_pagination'.format(what_type)] += len(url_ids)
+
+
+def defer_url(hostname, url):
+    '''Puts a URL of a host with an open circuit back for later.
+
+    Wpull marks the URL skipped; requeue_deferred_urls sets it back to todo
+    when the circuit is no longer open. Returns False if there is nothing
+    else to fetch in the meantime, after waiting out the cooldown.
+    '''
+    if not has_pending_urls():
+        time.sleep(circuit_breaker.remaining(hostname))
+        return False
+
+    deferred_urls[hostname].append(url)
+    url_filter_hits['circuit_open'] += 1
+    return True
+
+
+def has_pending_urls():
+    try:
+        db = sqlite3.connect(os.path.join(item_dir, 'wpull.db'), timeout=60)
+
+        try:
+            return db.execute(
+                'SELECT 1 FROM urls WHERE status IN (?, ?) LIMIT 1', ('todo', 'error')
+            ).fetchone() is not None
+        finally:
+            db.close()
+    except sqlite3.Error as error:
+        print_('Could not look for queued URLs: {0}'.format(error))
+        return True
+
+
+def requeue_deferred_urls(force=False):
+    '''Sets the deferred URLs of hosts that may be tried again to todo.
+
+    When nothing else is left to fetch, or with `force`, all of them are
+    set back. Returns how long to wait before the first may be fetched.
+    '''
+    if not deferred_urls:
         return 0
+
+    if not force and has_pending_urls():
+        hostnames = [
+            hostname for hostname in deferred_urls
+            if circuit_breaker.state(hostname) != CircuitBreaker.OPEN
+        ]
     else:
-        return seconds
+        hostnames = list(deferred_urls)
+
+    if not hostnames:
+        return 0
+
+    wait = min(circuit_breaker.remaining(hostname) for hostname in hostnames)
+    urls = [url for hostname in hostnames for url in deferred_urls.pop(hostname)]
+
+    try:
+        db = sqlite3.connect(os.path.join(item_dir, 'wpull.db'), timeout=60)
+
+        try:
+            with db:
+                db.executemany(
+                    'UPDATE urls SET status = ? WHERE status = ? AND url_str_id = '
+                    '(SELECT id FROM url_strings WHERE url = ?)',
+                    (('todo', 'skipped', url) for url in urls)
+                )
+        finally:
+            db.close()
+    except sqlite3.Error as error:
+        print_('Could not requeue deferred URLs: {0}'.format(error))
+        return 0
+
+    print_('Requeued {0} URLs of {1}.'.format(len(urls), ', '.join(hostnames)))
+
+    return wait
+
+
+def maintain_frontier():
+    '''Tunes and compacts wpull.db of items with lots of submissions.'''
+    global frontier_tuned
+
+    # Batched WARCs are split by the top URLs kept in the database.
+    if batch_size > 1 or (not lots_of_submissions and frontier_store.compacted is None):
+        return
+
+    if not frontier_tuned:
+        frontier_tuned = True
+        tune_wpull_database()
+
+    if total_tries % frontier.COMPACT_INTERVAL == 0:
+        try:
+            count = frontier_store.compact()
+        except sqlite3.Error as error:
+            print_('Could not compact the database: {0}'.format(error))
+        else:
+            print_('Moved {0} finished URLs out of the database.'.format(count))
+
+
+def tune_wpull_database():
+    '''Applies the frontier pragmas to wpull's own database connection.'''
+    try:
+        engine = wpull_hook.factory['URLTable'].url_table._engine
+    except (AttributeError, KeyError):
+        print_('Could not reach the wpull database to tune it.')
+        return
+
+    try:
+        connection = engine.raw_connection()
+
+        try:
+            frontier.tune(connection, frontier_store.memory_limit)
+        finally:
+            connection.close()
+    except sqlite3.Error as error:
+        print_('Could not tune the database: {0}'.format(error))
+
+
+def write_url_filter_stats():
+    stats = dict(url_filter_stats)
+    stats['hits'] = dict(url_filter_hits)
+
+    with open(os.path.join(item_dir, 'url_filter_stats.json'), 'w') as file:
+        json.dump(stats, file, indent=2, sort_keys=True)
+
+
+def finish_statistics(start_time, end_time, num_urls, bytes_downloaded):
+    write_url_filter_stats()
+
+
+def exit_status(exit_code):
+    # So a resumed attempt fetches them
+    requeue_deferred_urls(force=True)
+
+    if batch_size > 1:
+        write_shared_urls()
+
+    if hook_profiler:
+        hook_profiler.dump()
+
+    return exit_code
+
+
+def wait_time(seconds, url_info, url_record, response, error):
+    global request_start_time
+
+    requeue_wait = requeue_deferred_urls()
+    hostname = url_info['hostname']
+    host_class = rate_controller.host_class(hostname)
+
+    if not host_class:
+        request_start_time = None
+        return max(seconds, requeue_wait)
+
+    delay = rate_controller.delay(host_class)
+
+    if error:
+        delay = max(delay, seconds)
+    else:
+        # Like --random-wait
+        delay *= random.uniform(0.5, 1.5)
+
+    delay = max(delay, rate_controller.min_delay)
+    # The wait holds back whatever wpull fetches next, so a cooldown only
+    # goes into it when the URLs of cooling hosts are all that is left.
+    delay = max(delay, requeue_wait)
+    request_start_time = time.time() + delay
+
+    return delay
 
 
 wpull_hook.callbacks.engine_run = engine_run
@@ -306,6 +1187,12 @@ wpull_hook.callbacks.handle_response = handle_response
 wpull_hook.callbacks.handle_error = handle_error
 wpull_hook.callbacks.get_urls = get_urls
 wpull_hook.callbacks.wait_time = wait_time
-# wpull_hook.callbacks.finish_statistics = finish_statistics
-# wpull_hook.callbacks.exit_status = exit_status
+wpull_hook.callbacks.finish_statistics = finish_statistics
+wpull_hook.callbacks.exit_status = exit_status
 wpull_hook.callbacks.version = 3
+
+if hook_profiler:
+    hook_profiler.install(wpull_hook.callbacks, (
+        'accept_url', 'handle_pre_response', 'handle_response',
+        'handle_error', 'get_urls', 'wait_time',
+    ))
@@ -2,11 +2,14 @@ from __future__ import print_function
 import base64
 import codecs
 import cookielib
+import io
 import json
 import os
 import random
 import socket
+import sqlite3
 import time
+import zlib
 
 import requests
 import requests.exceptions
@@ -40,6 +43,14 @@ def main():
         'logged_in': False
     }
 
+    if os.environ.get('session_pool'):
+        session_pool = SessionPool(
+            os.environ['session_pool'],
+            max_size=int(os.environ.get('session_pool_size') or 6),
+        )
+    else:
+        session_pool = None
+
     def fetch(url, method='get', data=None, expect_status=200, headers=None):
         headers = {'user-agent': user_agent}
 
@@ -68,15 +79,14 @@ def main():
             )
 
             if response.status_code != expect_status and not ok_text_found:
-                print_('Problem detected. Sleeping.')
-                time.sleep(60)
+                sleep_time = min(60, 5 * 2 ** try_num)
+                print_('Problem detected. Sleeping {0} seconds.'.format(sleep_time))
+                time.sleep(sleep_time)
             elif ok_text_found and not is_404_error_page and state['logged_in'] and '/logout/' not in response.text:
-                print_('Problem detected. Not logged in! Sleeping.')
-                time.sleep(60)
+                print_('Problem detected. Not logged in!')
                 raise Exception('Not logged in!')
             elif ok_text_found and not is_404_error_page and state['logged_in'] and 'Toggle to hide Mature and Adult submissions.' not in response.text:
-                print_('Problem detected. Cannot view adult material! Sleeping.')
-                time.sleep(60)
+                print_('Problem detected. Cannot view adult material!')
                 raise Exception('Cannot view adult material!')
             else:
                 time.sleep(random.uniform(0.5, 1.5))
@@ -139,7 +149,41 @@ def main():
         state['logged_in'] = False
         fetch('https://www.furaffinity.net/logout/', expect_status=302)
 
+    def reuse_pooled_session():
+        while True:
+            age = session_pool.take(cookie_jar.filename)
+
+            if age is None:
+                return False
+
+            print_('Load pooled cookies')
+            cookie_jar.load()
+
+            if len(cookie_jar) and age < session_pool.trust_time:
+                print_('Session was fine {0:.0f} seconds ago. Reusing it.'.format(age))
+                return True
+
+            if len(cookie_jar):
+                print_('Check pooled session...', end='')
+                response = requests_session.get(
+                    'https://www.furaffinity.net/',
+                    headers={'user-agent': user_agent}, timeout=60
+                )
+                print_(str(response.status_code))
+
+                if response.status_code == 200 and '/logout/' in response.text:
+                    print_('Still logged in. Reusing it.')
+                    os.utime(cookie_jar.filename, None)
+                    return True
+
+            print_('Session expired.')
+            cookie_jar.clear()
+            os.remove(cookie_jar.filename)
+
     if command == 'begin':
+        if session_pool and reuse_pooled_session():
+            return
+
         login()
 
         print_('Save cookies.')
@@ -150,50 +194,203 @@ def main():
         print_('Load cookies')
         cookie_jar.load()
 
-        logout()
+        if session_pool and session_pool.put(cookie_jar.filename):
+            print_('Returned session to the pool.')
+        else:
+            logout()
 
         scraped_usernames = set()
 
-        with open(os.path.join(item_dir, 'usernames.txt'), 'r') as file:
+        with io.open(os.path.join(item_dir, 'usernames.txt'), 'r', encoding='utf8', errors='replace') as file:
             for line in file:
-                scraped_usernames.add(line.strip())
+                username = line.strip()
+
+                if username:
+                    scraped_usernames.add(username)
+
+        if os.environ.get('username_cache'):
+            cache = ReportedUsernameCache(
+                os.environ['username_cache'],
+                ttl=float(os.environ.get('username_cache_ttl') or 86400),
+                max_size=int(os.environ.get('username_cache_size') or 1000000),
+            )
+            new_usernames = cache.filter_unreported(scraped_usernames)
+            print_('{0} of {1} usernames not reported by this node yet.'.format(
+                len(new_usernames), len(scraped_usernames)))
+        else:
+            cache = None
+            new_usernames = scraped_usernames
+
+        if not new_usernames:
+            print_('Nothing new to upload.')
+            return
 
         results = {
-            'discovered_usernames': tuple(scraped_usernames),
+            'discovered_usernames': tuple(new_usernames),
             'username_disabled_map': {}
         }
 
-        upload_username_results(results, disco_tracker, scraped_from_private=True)
+        upload_username_results(
+            results, disco_tracker, scraped_from_private=True,
+            compress=(os.environ.get('compress_uploads') or '0') != '0',
+            on_chunk_uploaded=cache.mark_reported if cache else None
+        )
     else:
         raise Exception('Unknown command.')
 
 
-def upload_username_results(results, tracker_url, scraped_from_private=False):
+class SessionPool(object):
+    '''Logged in cookie jars kept on this node between items.
+
+    A jar is leased by renaming it out of the pool directory, so concurrent
+    items never share one. A jar's mtime is the last time it was known to
+    be logged in; younger than `trust_time` seconds, it is used unchecked.
+    '''
+    def __init__(self, path, max_size=6, trust_time=600):
+        self.path = path
+        self.max_size = max_size
+        self.trust_time = trust_time
+
+    def take(self, cookie_path):
+        for name in sorted(os.listdir(self.path)):
+            try:
+                os.rename(os.path.join(self.path, name), cookie_path)
+            except OSError:
+                # Another item got it first
+                continue
+
+            return time.time() - os.path.getmtime(cookie_path)
+
+    def put(self, cookie_path):
+        if len(os.listdir(self.path)) >= self.max_size:
+            return False
+
+        os.utime(cookie_path, None)
+        os.rename(
+            cookie_path,
+            os.path.join(self.path, '{0:016x}.txt'.format(random.getrandbits(64)))
+        )
+        return True
+
+
+class ReportedUsernameCache(object):
+    '''Usernames this node has already sent to the disco tracker.
+
+    Shared by all items on the node. Entries expire after `ttl` seconds and
+    the oldest ones are evicted once there are more than `max_size`.
+    '''
+    QUERY_CHUNK_SIZE = 500
+
+    def __init__(self, path, ttl=86400, max_size=1000000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS reported_usernames '
+            '(username TEXT PRIMARY KEY, reported_at REAL NOT NULL)'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS reported_usernames_reported_at '
+            'ON reported_usernames (reported_at)'
+        )
+        self.db.commit()
+
+    def filter_unreported(self, usernames):
+        usernames = list(usernames)
+        cutoff = time.time() - self.ttl
+        reported = set()
+
+        for index in range(0, len(usernames), self.QUERY_CHUNK_SIZE):
+            chunk = usernames[index:index + self.QUERY_CHUNK_SIZE]
+            rows = self.db.execute(
+                'SELECT username FROM reported_usernames '
+                'WHERE reported_at >= ? AND username IN ({0})'.format(','.join('?' * len(chunk))),
+                [cutoff] + chunk
+            )
+            reported.update(row[0] for row in rows)
+
+        return [username for username in usernames if username not in reported]
+
+    def mark_reported(self, usernames):
+        now = time.time()
+
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO reported_usernames (username, reported_at) VALUES (?, ?)',
+                ((username, now) for username in usernames)
+            )
+            self.db.execute(
+                'DELETE FROM reported_usernames WHERE reported_at < ?',
+                (now - self.ttl,)
+            )
+            self.db.execute(
+                'DELETE FROM reported_usernames WHERE username IN ('
+                'SELECT username FROM reported_usernames ORDER BY reported_at '
+                'LIMIT max((SELECT count(*) FROM reported_usernames) - ?, 0))',
+                (self.max_size,)
+            )
+
+
+UPLOAD_CHUNK_SIZE = 5000
+tracker_session = requests.Session()
+
+
+def upload_username_results(results, tracker_url, scraped_from_private=False,
+                            compress=False, on_chunk_uploaded=None):
     if scraped_from_private:
         url = tracker_url + '/api/user_private_discovery'
     else:
         url = tracker_url + '/api/user_discovery'
 
+    usernames = list(results['discovered_usernames'])
+    num_chunks = max(1, (len(usernames) + UPLOAD_CHUNK_SIZE - 1) // UPLOAD_CHUNK_SIZE)
+
+    # Each chunk is retried on its own, so a failure late in a big upload
+    # doesn't send the earlier chunks again.
+    for chunk_num in range(num_chunks):
+        chunk = usernames[chunk_num * UPLOAD_CHUNK_SIZE:(chunk_num + 1) * UPLOAD_CHUNK_SIZE]
+        chunk_results = dict(results)
+        chunk_results['discovered_usernames'] = tuple(chunk)
+
+        if chunk_num > 0:
+            chunk_results['username_disabled_map'] = {}
+
+        print_('Chunk {0}/{1}: {2} usernames.'.format(chunk_num + 1, num_chunks, len(chunk)))
+        upload_chunk(url, chunk_results, compress=compress)
+
+        if on_chunk_uploaded:
+            on_chunk_uploaded(chunk)
+
+
+def upload_chunk(url, results, compress=False):
+    data = json.dumps(results).encode('ascii')
+    headers = {'content-type': 'application/json'}
+
+    if compress:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(data) + compressor.flush()
+        headers['content-encoding'] = 'gzip'
+
     for try_count in range(10):
         print_('Uploading results...', end='')
         try:
-            response = requests.post(
+            response = tracker_session.post(
                 url,
-                data=json.dumps(results).encode('ascii'),
+                data=data,
+                headers=headers,
                 timeout=60
             )
-        except requests.exceptions.ConnectionError:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             print_('Connection error.')
-            print_('Sleeping...')
-            time.sleep(60)
         else:
             print_(response.status_code)
 
             if response.status_code == 200:
                 return
-            else:
-                print_('Sleeping...')
-                time.sleep(60)
+
+        sleep_time = min(60, 5 * 2 ** try_count)
+        print_('Sleeping {0} seconds...'.format(sleep_time))
+        time.sleep(sleep_time)
 
     raise Exception('Failed to upload.')
 
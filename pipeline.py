@@ -1,21 +1,34 @@
 from distutils.version import StrictVersion
+import base64
+import collections
 import datetime
+import functools
 import hashlib
+import io
+import itertools
+import json
 import os
 import random
 import re
 import socket
 import shutil
+import sqlite3
+import threading
 import time
+import traceback
 import sys
+import uuid
+import zlib
+
+from tornado.ioloop import IOLoop
 
 import seesaw
 from seesaw.config import realize, NumberConfigValue
-from seesaw.externalprocess import WgetDownload, ExternalProcess
+from seesaw.externalprocess import WgetDownload, ExternalProcess, RsyncUpload
 from seesaw.item import ItemInterpolation, ItemValue
 from seesaw.pipeline import Pipeline
 from seesaw.project import Project
-from seesaw.task import SimpleTask, SetItemKey, LimitConcurrent
+from seesaw.task import Task, SimpleTask, SetItemKey, LimitConcurrent
 from seesaw.tracker import PrepareStatsForTracker, GetItemFromTracker, \
     UploadWithTracker, SendDoneToTracker
 from seesaw.util import find_executable
@@ -26,23 +39,108 @@ if StrictVersion(seesaw.__version__) < StrictVersion("0.8.3"):
     raise Exception("This pipeline needs seesaw version 0.8.3 or higher.")
 
 
+CWD = os.getcwd()
+
+# Address of a running simulator.py. Wpull and helper.py reach the sites
+# and the disco tracker through it as a proxy; it is also the tracker.
+SIMULATOR = globals().get('simulator')
+
+# Node-local state shared by all items running from this directory. Runs
+# against the simulator keep theirs apart, next to the simulator's own.
+if SIMULATOR:
+    STATE_DIR = os.path.join(CWD, 'state', 'simulator')
+else:
+    STATE_DIR = os.path.join(CWD, 'state')
+
+SESSION_POOL_DIR = os.path.join(STATE_DIR, 'sessions')
+DEDUP_INDEX = os.path.join(STATE_DIR, 'dedup.cdx')
+CDN_FILTER = os.path.join(STATE_DIR, 'cdn_filter.bloom')
+
+if not os.path.isdir(SESSION_POOL_DIR):
+    os.makedirs(SESSION_POOL_DIR)
+
+STARTUP_CACHE = os.path.join(STATE_DIR, 'startup_cache.json')
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def load_startup_cache():
+    try:
+        with open(STARTUP_CACHE, 'r') as in_file:
+            return json.load(in_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_startup_cache():
+    temp_path = STARTUP_CACHE + '.tmp'
+
+    with open(temp_path, 'w') as out_file:
+        json.dump(startup_cache, out_file)
+
+    os.rename(temp_path, STARTUP_CACHE)
+
+
+startup_cache = load_startup_cache()
+
+
 ###########################################################################
 # Find a useful Wpull executable.
 #
 # WPULL_EXE will be set to the first path that
 # 1. does not crash with --version, and
 # 2. prints the required version string
-WPULL_EXE = find_executable(
-    "Wpull",
-    re.compile(r"\b1\.0\b"),
-    [
-        "./wpull",
-        os.path.expanduser("~/.local/share/wpull-1.0/wpull"),
-        os.path.expanduser("~/.local/bin/wpull"),
-        "./wpull_bootstrap",
-        "wpull",
-    ]
-)
+#
+# Probing runs every candidate, so the result is remembered in the startup
+# cache until the executable changes.
+WPULL_VERSION_RE = r"\b1\.0\b"
+WPULL_CANDIDATES = [
+    "./wpull",
+    os.path.expanduser("~/.local/share/wpull-1.0/wpull"),
+    os.path.expanduser("~/.local/bin/wpull"),
+    "./wpull_bootstrap",
+    "wpull",
+]
+
+
+def find_wpull():
+    cached = startup_cache.get('wpull')
+
+    if cached and cached['version_re'] == WPULL_VERSION_RE and \
+            cached['candidates'] == WPULL_CANDIDATES:
+        try:
+            if file_signature(cached['resolved_path']) == cached['signature']:
+                return cached['path']
+        except OSError:
+            pass
+
+    path = find_executable("Wpull", re.compile(WPULL_VERSION_RE), WPULL_CANDIDATES)
+
+    if path:
+        resolved_path = path
+
+        if os.sep not in path:
+            for directory in os.environ.get('PATH', '').split(os.pathsep):
+                if os.path.exists(os.path.join(directory, path)):
+                    resolved_path = os.path.join(directory, path)
+                    break
+
+        startup_cache['wpull'] = {
+            'path': path,
+            'resolved_path': resolved_path,
+            'signature': file_signature(resolved_path),
+            'version_re': WPULL_VERSION_RE,
+            'candidates': WPULL_CANDIDATES,
+        }
+        save_startup_cache()
+
+    return path
+
+
+WPULL_EXE = find_wpull()
 
 if not WPULL_EXE:
     raise Exception("No usable Wpull found.")
@@ -59,6 +157,16 @@ TRACKER_ID = 'furaffinity'
 TRACKER_HOST = 'tracker.archiveteam.org'
 DISCO_TRACKER_URL = 'http://tracker.archiveteam.org/' + '_fa_disco'
 
+if SIMULATOR:
+    TRACKER_HOST = SIMULATOR
+    SIMULATOR_ENV = {
+        'http_proxy': 'http://' + SIMULATOR,
+        'https_proxy': 'http://' + SIMULATOR,
+        'REQUESTS_CA_BUNDLE': os.path.join(STATE_DIR, 'cert.pem'),
+    }
+else:
+    SIMULATOR_ENV = {}
+
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/40.0.2214.115 Safari/537.36',
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_2) AppleWebKit/600.3.18 (KHTML, like Gecko) Version/8.0.3 Safari/600.3.18',
@@ -95,40 +203,144 @@ user_agent = make_user_agent(realize(downloader))
 
 
 class CheckIP(SimpleTask):
+    HOSTNAMES = (
+        'twitter.com',
+        'facebook.com',
+        'youtube.com',
+        'microsoft.com',
+        'icanhas.cheezburger.com',
+        'archiveteam.org',
+    )
+    CHECK_INTERVAL = 300
+    MAX_AGE = 900
+
     def __init__(self):
         SimpleTask.__init__(self, "CheckIP")
-        self._counter = 0
+        self._checked_at = None
+        self._ip_set = None
+        self._thread = None
 
     def process(self, item):
-        if self._counter <= 0:
+        if SIMULATOR:
+            return
+
+        if self._thread is None:
+            # Keep the result fresh in the background so items don't
+            # have to wait for DNS.
+            self._thread = threading.Thread(target=self._check_periodically)
+            self._thread.daemon = True
+            self._thread.start()
+
+        if self._ip_set is None or len(self._ip_set) != len(self.HOSTNAMES) or \
+                time.time() - self._checked_at > self.MAX_AGE:
             item.log_output('Checking IP address.')
-            ip_set = set()
-
-            ip_set.add(socket.gethostbyname('twitter.com'))
-            ip_set.add(socket.gethostbyname('facebook.com'))
-            ip_set.add(socket.gethostbyname('youtube.com'))
-            ip_set.add(socket.gethostbyname('microsoft.com'))
-            ip_set.add(socket.gethostbyname('icanhas.cheezburger.com'))
-            ip_set.add(socket.gethostbyname('archiveteam.org'))
-
-            if len(ip_set) != 6:
-                item.log_output('Got IP addresses: {0}'.format(ip_set))
-                item.log_output(
-                    'You are behind a firewall or proxy. That is a big no-no!')
-                raise Exception(
-                    'You are behind a firewall or proxy. That is a big no-no!')
-
-        # Check only occasionally
-        if self._counter <= 0:
-            self._counter = 10
+            self._check()
+
+        if len(self._ip_set) != len(self.HOSTNAMES):
+            item.log_output('Got IP addresses: {0}'.format(self._ip_set))
+            item.log_output(
+                'You are behind a firewall or proxy. That is a big no-no!')
+            raise Exception(
+                'You are behind a firewall or proxy. That is a big no-no!')
+
+    def _check(self):
+        results = {}
+
+        def resolve(hostname):
+            try:
+                results[hostname] = socket.gethostbyname(hostname)
+            except socket.error:
+                pass
+
+        threads = [threading.Thread(target=resolve, args=(hostname,))
+                   for hostname in self.HOSTNAMES]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for thread in threads:
+            thread.join(60)
+
+        self._ip_set = set(results.values())
+        self._checked_at = time.time()
+
+    def _check_periodically(self):
+        while True:
+            time.sleep(self.CHECK_INTERVAL)
+            self._check()
+
+
+class ThreadedTask(Task):
+    '''A SimpleTask that can hand the slow part of its work to a thread.
+
+    process(item) runs on the IOLoop and may return a function, which then
+    runs in a thread of its own, so reading or writing whole WARCs doesn't
+    hold up the other items. The function must leave the item alone; what
+    it returns is logged once the item is back on the IOLoop.
+    '''
+    def enqueue(self, item):
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+
+        try:
+            work = self.process(item)
+        except Exception as error:
+            self._failed(item, error, traceback.format_exc())
+            return
+
+        if work is None:
+            self._done(item, None)
+            return
+
+        thread = threading.Thread(target=self._run, args=(item, work))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, item, work):
+        try:
+            message = work()
+        except Exception as error:
+            callback = functools.partial(self._failed, item, error, traceback.format_exc())
         else:
-            self._counter -= 1
+            callback = functools.partial(self._done, item, message)
 
+        IOLoop.instance().add_callback(callback)
 
-class PrepareDirectories(SimpleTask):
-    def __init__(self, warc_prefix):
-        SimpleTask.__init__(self, "PrepareDirectories")
+    def _done(self, item, message):
+        if message:
+            item.log_output(message)
+
+        item.log_output("Finished %s for %s\n" % (self, item.description()))
+        self.complete_item(item)
+
+    def _failed(self, item, error, trace):
+        item.log_output("Failed %s for %s\n" % (self, item.description()))
+        item.log_output("%s\n" % trace)
+        item.log_error(self, error)
+        self.fail_item(item)
+
+    def process(self, item):
+        pass
+
+    def __str__(self):
+        return self.name
+
+
+class PrepareDirectories(ThreadedTask):
+    '''Makes the item directory.
+
+    With `resume`, the directory lives in data/resume/ under a name derived
+    from the item name, and survives a failed attempt. When the item comes
+    back, wpull picks up its database where it stopped and writes a new
+    WARC segment; MergeWarcSegments joins the segments afterwards. Resume
+    directories untouched for `resume_max_age` seconds are removed.
+    '''
+    def __init__(self, warc_prefix, resume=True, resume_max_age=2 * 86400):
+        ThreadedTask.__init__(self, "PrepareDirectories")
         self.warc_prefix = warc_prefix
+        self.resume = resume
+        self.resume_max_age = resume_max_age
 
     def process(self, item):
         item_name = item["item_name"]
@@ -136,12 +348,25 @@ class PrepareDirectories(SimpleTask):
         escaped_item_name = hashlib.sha1(item_name.encode('ascii')).hexdigest()
         item['escaped_item_name'] = escaped_item_name
 
-        dirname = "/".join((item["data_dir"], escaped_item_name))
+        if self.resume:
+            resume_dir = os.path.join(os.path.dirname(item["data_dir"]), 'resume')
+            self._remove_stale(resume_dir)
+            dirname = os.path.join(resume_dir, escaped_item_name)
+        else:
+            dirname = "/".join((item["data_dir"], escaped_item_name))
 
-        if os.path.isdir(dirname):
-            shutil.rmtree(dirname)
+        segments = []
 
-        os.makedirs(dirname)
+        if self.resume and os.path.exists(os.path.join(dirname, 'wpull.db')):
+            segments = warc_segments(dirname, self.warc_prefix, escaped_item_name)
+            item.log_output('Resuming the item after {0} earlier WARC segments.'.format(
+                len(segments)))
+            item["resumed"] = True
+        else:
+            if os.path.isdir(dirname):
+                shutil.rmtree(dirname)
+
+            os.makedirs(dirname)
 
         item["item_dir"] = dirname
         item["warc_file_base"] = "%s-%s-%s" % (
@@ -151,6 +376,406 @@ class PrepareDirectories(SimpleTask):
 
         open("%(item_dir)s/%(warc_file_base)s.warc.gz" % item, "w").close()
 
+        if segments:
+            return functools.partial(self._truncate, segments)
+
+    @staticmethod
+    def _truncate(segments):
+        for path in segments:
+            truncate_incomplete_gzip(path)
+
+    def _remove_stale(self, resume_dir):
+        if not os.path.isdir(resume_dir):
+            return
+
+        for name in os.listdir(resume_dir):
+            path = os.path.join(resume_dir, name)
+            db_path = os.path.join(path, 'wpull.db')
+            last_change = os.path.getmtime(path)
+
+            if os.path.exists(db_path):
+                last_change = max(last_change, os.path.getmtime(db_path))
+
+            if time.time() - last_change > self.resume_max_age:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+def warc_segments(dirname, warc_prefix, escaped_item_name):
+    '''Returns the WARC files of an item directory, oldest first.'''
+    prefix = "%s-%s-" % (warc_prefix, escaped_item_name)
+
+    return sorted(
+        os.path.join(dirname, name) for name in os.listdir(dirname)
+        if name.startswith(prefix) and name.endswith('.warc.gz')
+    )
+
+
+def gzip_members(path, head_size=0):
+    '''Yields (start, end, head) for each complete member of a gzip file.
+
+    `head` holds the first `head_size` uncompressed bytes of the member.
+    Stops at the first incomplete or corrupt member.
+    '''
+    start = offset = 0
+    head = b''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    with open(path, 'rb') as in_file:
+        # The extra byte ends up in unused_data only if the last member
+        # is complete.
+        chunks = itertools.chain(
+            iter(functools.partial(in_file.read, 1048576), b''), [b'\0'])
+
+        for data in chunks:
+            while data:
+                try:
+                    output = decompressor.decompress(data)
+                except zlib.error:
+                    # Garbage after the last complete member
+                    return
+
+                if len(head) < head_size:
+                    head += output[:head_size - len(head)]
+
+                if decompressor.unused_data:
+                    offset += len(data) - len(decompressor.unused_data)
+                    yield start, offset, head
+                    start = offset
+                    head = b''
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    offset += len(data)
+                    data = b''
+
+
+def truncate_incomplete_gzip(path):
+    '''Cuts a gzip file after its last complete member.
+
+    Wpull compresses every WARC record as a member of its own, so this
+    drops a record that was being written when wpull was interrupted.
+    '''
+    complete_length = 0
+
+    for dummy, end, dummy in gzip_members(path):
+        complete_length = end
+
+    if complete_length < os.path.getsize(path):
+        with open(path, 'r+b') as out_file:
+            out_file.truncate(complete_length)
+
+
+class MergeWarcSegments(ThreadedTask):
+    '''Joins the WARC segments of a resumed item into the current one.
+
+    Gzipped WARCs are series of gzip members, so the segments are simply
+    appended to the oldest one, which then takes the current name.
+    '''
+    def __init__(self, warc_prefix):
+        ThreadedTask.__init__(self, "MergeWarcSegments")
+        self.warc_prefix = warc_prefix
+
+    def process(self, item):
+        segments = warc_segments(item["item_dir"], self.warc_prefix, item["escaped_item_name"])
+
+        if len(segments) < 2:
+            return
+
+        return functools.partial(
+            self._merge, segments, "%(item_dir)s/%(warc_file_base)s.warc.gz" % item)
+
+    @staticmethod
+    def _merge(segments, warc_path):
+        with open(segments[0], 'ab') as out_file:
+            for path in segments[1:]:
+                with open(path, 'rb') as in_file:
+                    shutil.copyfileobj(in_file, out_file, 1048576)
+
+                os.remove(path)
+
+        os.rename(segments[0], warc_path)
+
+        return 'Merged {0} WARC segments.'.format(len(segments))
+
+
+def replace_warc_fields(header, fields):
+    '''Returns a WARC record header with the values of `fields` replaced.
+
+    `fields` maps lowercase field names to their new values; fields the
+    header doesn't have are left out.
+    '''
+    lines = header.split(b'\r\n')
+
+    for index, line in enumerate(lines[1:], 1):
+        name = line.partition(b':')[0]
+
+        if name.strip().lower() in fields:
+            lines[index] = name + b': ' + fields[name.strip().lower()]
+
+    return b'\r\n'.join(lines)
+
+
+def copy_warc_record(in_file, start, end, out_file, fields=None):
+    '''Copies the gzipped WARC record between `start` and `end` of in_file.
+
+    With `fields`, the record is recompressed with the header changed by
+    replace_warc_fields.
+    '''
+    in_file.seek(start)
+    remaining = end - start
+
+    if not fields:
+        while remaining:
+            data = in_file.read(min(remaining, 1048576))
+            out_file.write(data)
+            remaining -= len(data)
+
+        return
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    head = b''
+
+    while remaining:
+        data = in_file.read(min(remaining, 1048576))
+        remaining -= len(data)
+        data = decompressor.decompress(data)
+
+        if head is not None:
+            head += data
+
+            if b'\r\n\r\n' not in head and remaining:
+                continue
+
+            header, separator, data = head.partition(b'\r\n\r\n')
+            data = replace_warc_fields(header, fields) + separator + data
+            head = None
+
+        out_file.write(compressor.compress(data))
+
+    out_file.write(compressor.compress(decompressor.flush()) + compressor.flush())
+
+
+def make_warcinfo(record, item_name, record_id=None):
+    '''Returns a gzipped copy of a warcinfo record naming only `item_name`.
+
+    `record` is the uncompressed warcinfo record of a batch. The copy gets
+    `record_id`, if given, and a block digest to match its new block.
+    '''
+    header, separator, rest = record.partition(b'\r\n\r\n')
+    length = int(re.search(br'(?im)^content-length:\s*(\d+)', header).group(1))
+    block = re.sub(
+        br'(?m)^furaffinity-user:[^\r\n]*',
+        b'furaffinity-user: ' + item_name.encode('utf8'), rest[:length])
+    digest = b'sha1:' + base64.b32encode(hashlib.sha1(block).digest())
+    fields = {
+        b'content-length': str(len(block)).encode('ascii'),
+        b'warc-block-digest': digest,
+        b'warc-payload-digest': digest,
+    }
+
+    if record_id:
+        fields[b'warc-record-id'] = record_id
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    return compressor.compress(
+        replace_warc_fields(header, fields) + separator + block + rest[length:]
+    ) + compressor.flush()
+
+
+def new_record_id():
+    return ('<%s>' % uuid.uuid4().urn).encode('ascii')
+
+
+def copied_record_id(record_id, item):
+    '''Returns the ID of the copy of a record in the WARC of `item`.
+
+    The same for every record that refers to it, so a copied request
+    stays concurrent to its copied response.
+    '''
+    return ('<%s>' % uuid.uuid5(
+        uuid.NAMESPACE_URL, item["item_name"] + record_id.decode('ascii')).urn
+    ).encode('ascii')
+
+
+def split_batch_warc(leader, items):
+    '''Splits the WARC of a batched download into one WARC per item.
+
+    Each record goes to the item whose seed URL led wpull to it, which the
+    wpull database keeps as the top URL of every URL. Records of URLs that
+    furaffinity.py found under the seeds of several items, like a thumbnail
+    on the pages of two ranges, are copied to each of them under new record
+    IDs. Every item gets a warcinfo record naming only itself, and the CDX
+    file is split along. Records that can't be attributed, like the log
+    wpull appends at the end, stay with the leader.
+
+    Runs outside the IOLoop, so it doesn't log to the items; returns the
+    number of records each item got instead.
+    '''
+    warc_path = "%(item_dir)s/%(warc_file_base)s.warc.gz" % leader
+    cdx_path = "%(item_dir)s/%(warc_file_base)s.cdx" % leader
+    shared_path = os.path.join(leader["item_dir"], 'shared_urls.json')
+    item_for_name = dict((item["item_name"], item) for item in items)
+    item_for_seed = {}
+    shared_urls = {}
+
+    for item in items:
+        for url in seed_urls(item["item_name"]):
+            item_for_seed[url] = item
+
+    if os.path.exists(shared_path):
+        with open(shared_path, 'r') as in_file:
+            shared_urls = json.load(in_file)
+
+    connection = sqlite3.connect(os.path.join(leader["item_dir"], 'wpull.db'))
+
+    try:
+        top_urls = dict(connection.execute(
+            'SELECT url_strings.url, top_url_strings.url FROM urls '
+            'JOIN url_strings ON urls.url_str_id = url_strings.id '
+            'LEFT JOIN url_strings AS top_url_strings '
+            'ON urls.top_url_str_id = top_url_strings.id'
+        ))
+    finally:
+        connection.close()
+
+    out_paths = dict(
+        (item, "%(item_dir)s/%(warc_file_base)s.warc.gz" % item)
+        for item in items)
+    out_paths[leader] = warc_path + '.split'
+    out_files = dict((item, open(out_paths[item], 'wb')) for item in items)
+    warcinfo_ids = {}
+    # (item, offset in the batch WARC) -> (offset, length, record ID) of
+    # the responses, for the CDX files
+    locations = {}
+    counts = collections.Counter()
+
+    try:
+        with open(warc_path, 'rb') as in_file:
+            for start, end, head in gzip_members(warc_path, 4096):
+                fields = {}
+
+                for line in head.split(b'\r\n\r\n', 1)[0].split(b'\r\n')[1:]:
+                    name, dummy, value = line.partition(b':')
+                    fields[name.strip().lower()] = value.strip()
+
+                if fields.get(b'warc-type') == b'warcinfo':
+                    in_file.seek(start)
+                    record = zlib.decompress(in_file.read(end - start), 16 + zlib.MAX_WBITS)
+
+                    for item in items:
+                        if item is not leader:
+                            warcinfo_ids[item] = new_record_id()
+
+                        out_files[item].write(make_warcinfo(
+                            record, item["item_name"], warcinfo_ids.get(item)))
+                        counts[item] += 1
+
+                    continue
+
+                url = fields.get(b'warc-target-uri', b'').decode('utf8', 'replace')
+                top_url = top_urls.get(url) or url
+                targets = [item_for_seed.get(top_url, leader)]
+
+                for name in shared_urls.get(url, ()):
+                    if name in item_for_name and item_for_name[name] not in targets:
+                        targets.append(item_for_name[name])
+
+                for item in targets:
+                    record_fields = {}
+
+                    if item in warcinfo_ids and b'warc-warcinfo-id' in fields:
+                        record_fields[b'warc-warcinfo-id'] = warcinfo_ids[item]
+
+                    if item is not targets[0]:
+                        for name in (b'warc-record-id', b'warc-concurrent-to'):
+                            if name in fields:
+                                record_fields[name] = copied_record_id(fields[name], item)
+
+                    offset = out_files[item].tell()
+                    copy_warc_record(in_file, start, end, out_files[item], record_fields)
+                    counts[item] += 1
+
+                    if fields.get(b'warc-type') == b'response':
+                        locations[(item, start)] = (
+                            offset, out_files[item].tell() - offset,
+                            record_fields.get(b'warc-record-id', fields.get(b'warc-record-id')))
+    finally:
+        for out_file in out_files.values():
+            out_file.close()
+
+    if os.path.exists(cdx_path):
+        split_batch_cdx(cdx_path, leader, items, locations)
+
+    os.rename(out_paths[leader], warc_path)
+
+    return counts
+
+
+def split_batch_cdx(cdx_path, leader, items, locations):
+    '''Writes the CDX lines of a batch WARC to the CDX files of its items.'''
+    out_paths = dict(
+        (item, "%(item_dir)s/%(warc_file_base)s.cdx" % item) for item in items)
+    out_paths[leader] = cdx_path + '.split'
+    out_files = dict(
+        (item, io.open(out_paths[item], 'w', encoding='utf8')) for item in items)
+
+    try:
+        with io.open(cdx_path, 'r', encoding='utf8') as in_file:
+            header = in_file.readline()
+
+            for out_file in out_files.values():
+                out_file.write(header)
+
+            for line in in_file:
+                fields = line.rstrip(u'\n').split(u' ')
+
+                if len(fields) != 9 or not fields[6].isdigit():
+                    continue
+
+                batch_offset = int(fields[6])
+
+                for item in items:
+                    location = locations.get((item, batch_offset))
+
+                    if location:
+                        offset, length, record_id = location
+                        out_fields = fields[:5] + [
+                            u'%d' % length, u'%d' % offset,
+                            u'%s.warc.gz' % item["warc_file_base"],
+                            record_id.decode('ascii'),
+                        ]
+                        out_files[item].write(u' '.join(out_fields) + u'\n')
+    finally:
+        for out_file in out_files.values():
+            out_file.close()
+
+    os.rename(out_paths[leader], cdx_path)
+
+
+class ReadCostEstimate(SimpleTask):
+    '''Puts the size estimate furaffinity.py made on the item.
+
+    It goes to the tracker with the stats, so heavy items can be told
+    apart before anyone looks at the WARCs.
+    '''
+    def __init__(self):
+        SimpleTask.__init__(self, "ReadCostEstimate")
+
+    def process(self, item):
+        path = os.path.join(item["item_dir"], 'cost_estimate.json')
+
+        if not os.path.exists(path):
+            return
+
+        with open(path, 'r') as in_file:
+            estimate = json.load(in_file)
+
+        item["cost_estimate"] = dict(
+            (key, estimate[key]) for key in ('urls', 'bytes', 'tries_budget'))
+        item.log_output('Estimated {urls} URLs and {bytes} bytes.'.format(**estimate))
+
 
 class MoveFiles(SimpleTask):
     def __init__(self):
@@ -164,15 +789,765 @@ class MoveFiles(SimpleTask):
         os.rename("%(item_dir)s/%(warc_file_base)s.warc.gz" % item,
                   "%(data_dir)s/%(warc_file_base)s.warc.gz" % item)
 
+        for name in ('hook_profile.json', 'hook_profile.pstats',
+                     '%(warc_file_base)s.cdx' % item):
+            if os.path.exists(os.path.join(item["item_dir"], name)):
+                os.rename(os.path.join(item["item_dir"], name),
+                          os.path.join(item["data_dir"], name))
+
         shutil.rmtree("%(item_dir)s" % item)
 
 
+class UpdateDedupIndex(SimpleTask):
+    '''Adds the CDN responses of a finished item to the node's dedup index.
+
+    Wpull loads the index with --warc-dedup and writes revisit records
+    instead of full copies for payloads an earlier item already archived,
+    so this runs only once the item is uploaded, on the CDX file MoveFiles
+    put next to the WARC.
+    Only the newest `max_records` entries are kept, since every wpull
+    process loads the whole index into its database at startup.
+    '''
+    CDX_HEADER = u' CDX a b m s k S V g u\n'
+
+    def __init__(self, path, max_records=200000):
+        SimpleTask.__init__(self, "UpdateDedupIndex")
+        self.path = path
+        self.max_records = max_records
+
+        if not os.path.exists(self.path):
+            self._write([])
+
+    def process(self, item):
+        cdx_path = "%(data_dir)s/%(warc_file_base)s.cdx" % item
+
+        if not os.path.exists(cdx_path):
+            return
+
+        new_records = []
+
+        with io.open(cdx_path, 'r', encoding='utf8') as in_file:
+            in_file.readline()
+
+            for line in in_file:
+                fields = line.split(u' ')
+
+                if len(fields) == 9 and 'facdn.net' in fields[0] and \
+                        fields[3] == u'200' and fields[4] != u'-':
+                    new_records.append(line)
+
+        if not new_records:
+            return
+
+        with io.open(self.path, 'r', encoding='utf8') as in_file:
+            in_file.readline()
+            records = in_file.readlines()
+
+        records.extend(new_records)
+        unique_records = []
+        seen = set()
+
+        for line in reversed(records):
+            fields = line.split(u' ')
+            key = (fields[0], fields[4])
+
+            if key not in seen:
+                seen.add(key)
+                unique_records.append(line)
+
+                if len(unique_records) >= self.max_records:
+                    break
+
+        unique_records.reverse()
+        self._write(unique_records)
+        item.log_output('Added {0} records to the dedup index.'.format(len(new_records)))
+
+    def _write(self, records):
+        temp_path = self.path + '.tmp'
+
+        with io.open(temp_path, 'w', encoding='utf8') as out_file:
+            out_file.write(self.CDX_HEADER)
+            out_file.writelines(records)
+
+        os.rename(temp_path, self.path)
+
+
+class LimitPrefetch(Task):
+    '''Bounds the number of items claimed ahead of the download slots.
+
+    Items pass this task before they are claimed from the tracker. Until
+    one of `download_tasks` starts on them (or they finish early), at most
+    `lookahead` items are let through; the rest wait here unclaimed, so
+    prepared items don't sit around long enough to expire.
+    '''
+    def __init__(self, lookahead, *download_tasks):
+        Task.__init__(self, "LimitPrefetch")
+        self.lookahead = lookahead
+        self._queue = []
+        self._prefetched = set()
+
+        for download_task in download_tasks:
+            download_task.on_start_item += self._download_started
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item.on_finish += self._item_finished
+
+        if len(self._prefetched) < realize(self.lookahead, item):
+            self._admit(item)
+        else:
+            item.log_output('Waiting for a download slot to free up.')
+            item.may_be_canceled = True
+            self._queue.append(item)
+
+    def _admit(self, item):
+        item.may_be_canceled = False
+        self._prefetched.add(item)
+        self.complete_item(item)
+
+    def _release(self, item):
+        if item in self._queue:
+            self._queue.remove(item)
+
+        if item in self._prefetched:
+            self._prefetched.remove(item)
+
+            while self._queue and len(self._prefetched) < realize(self.lookahead, item):
+                self._admit(self._queue.pop(0))
+
+    def _download_started(self, task, item):
+        self._release(item)
+
+    def _item_finished(self, item):
+        self._release(item)
+
+
+class BatchDownloads(Task):
+    '''Runs the downloads of several range items in one wpull process.
+
+    Submission and journal items are collected per type until there are
+    `batch_items` of them or the first has waited `batch_wait` seconds.
+    The first item of a batch, the leader, goes through `inner_tasks` one
+    after the other with the seeds of all of them, so only the leader logs
+    in, downloads and reports usernames. Afterwards its WARC is split up
+    again with split_batch_warc, in a thread so the IOLoop keeps going, and
+    every item still has a WARC of its own and is uploaded and reported on
+    its own. Other items, and items resuming an earlier attempt, go through
+    `inner_tasks` alone.
+
+    Items count as started (and so stop counting against LimitPrefetch)
+    when they join a batch, unless a full batch is still waiting for a
+    download process; then they start along with that batch.
+    '''
+    BATCHED_TYPES = ('submission', 'journal')
+
+    def __init__(self, inner_tasks, batch_items=1, batch_wait=30):
+        Task.__init__(self, "BatchDownloads")
+        self.inner_tasks = inner_tasks
+        self.batch_items = batch_items
+        self.batch_wait = batch_wait
+        self._batches = {}
+        self._running = {}
+        self._waiting = set()
+        self._unstarted = []
+
+        for index, inner_task in enumerate(inner_tasks):
+            inner_task.on_complete_item += functools.partial(self._inner_complete, index)
+            inner_task.on_fail_item += self._inner_fail
+
+            if isinstance(inner_task, LimitConcurrent):
+                inner_task.inner_task.on_start_item += self._inner_started
+
+    def fill_ui_task_list(self, task_list):
+        Task.fill_ui_task_list(self, task_list)
+
+        for inner_task in self.inner_tasks:
+            inner_task.fill_ui_task_list(task_list)
+
+    def enqueue(self, item):
+        item_type = item["item_name"].split(':', 1)[0]
+
+        if realize(self.batch_items, item) <= 1 or \
+                item_type not in self.BATCHED_TYPES or item.get("resumed"):
+            self._download([item])
+            return
+
+        if self._waiting:
+            self._unstarted.append(item)
+        else:
+            self.start_item(item)
+
+        batch = self._batches.get(item_type)
+
+        if batch is None:
+            batch = self._batches[item_type] = []
+            IOLoop.instance().add_timeout(
+                datetime.timedelta(seconds=self.batch_wait),
+                functools.partial(self._flush, item_type, batch))
+
+        batch.append(item)
+        item.log_output("Waiting to download with %d other items." % (len(batch) - 1))
+
+        if len(batch) >= realize(self.batch_items, item):
+            self._flush(item_type, batch)
+
+    def _flush(self, item_type, batch):
+        if self._batches.get(item_type) is not batch:
+            return
+
+        del self._batches[item_type]
+        self._waiting.add(batch[0])
+        self._download(batch)
+
+    def _download(self, items):
+        leader = items[0]
+        leader["batch_item_names"] = ",".join(item["item_name"] for item in items)
+        self._running[leader] = items
+
+        for item in items[1:]:
+            item.log_output("Downloading in the batch of %s." % leader["item_name"])
+
+        self.inner_tasks[0].enqueue(leader)
+
+    def _inner_started(self, task, leader):
+        if leader not in self._waiting:
+            return
+
+        self._waiting.remove(leader)
+        unstarted = list(self._unstarted)
+
+        if self._waiting:
+            # Start the members of this batch only
+            unstarted = [item for item in unstarted if item in self._running[leader]]
+
+        for item in unstarted:
+            self._unstarted.remove(item)
+            self.start_item(item)
+
+    def _inner_complete(self, index, task, leader):
+        if index + 1 < len(self.inner_tasks):
+            self.inner_tasks[index + 1].enqueue(leader)
+            return
+
+        items = self._running[leader]
+
+        if len(items) == 1:
+            del self._running[leader]
+            self.complete_item(leader)
+            return
+
+        thread = threading.Thread(target=self._split, args=(items,))
+        thread.daemon = True
+        thread.start()
+
+    def _split(self, items):
+        try:
+            counts = split_batch_warc(items[0], items)
+        except Exception as error:
+            callback = functools.partial(self._split_failed, items, error)
+        else:
+            callback = functools.partial(self._split_done, items, counts)
+
+        IOLoop.instance().add_callback(callback)
+
+    def _split_done(self, items, counts):
+        del self._running[items[0]]
+
+        for item in items:
+            item.log_output('Took {0} WARC records from the batch of {1}.'.format(
+                counts[item], items[0]["item_name"]))
+            self.complete_item(item)
+
+    def _split_failed(self, items, error):
+        items[0].log_output("Could not split the batch WARC: %s" % error)
+        self._fail(self._running.pop(items[0]))
+
+    def _inner_fail(self, task, leader):
+        self._fail(self._running.pop(leader))
+
+    def _fail(self, items):
+        self._waiting.discard(items[0])
+
+        for item in items:
+            if item in self._unstarted:
+                self._unstarted.remove(item)
+
+        if len(items) > 1:
+            # The database holds the URLs of the whole batch, so the leader
+            # must not resume from it on its own.
+            db_path = os.path.join(items[0]["item_dir"], 'wpull.db')
+
+            if os.path.exists(db_path):
+                os.remove(db_path)
+
+        for item in items:
+            self.fail_item(item)
+
+
+class AddressPool(object):
+    '''Spreads the items over the local addresses of a multi-IP node.
+
+    Every item leases an address, and with it the FA sessions pooled for
+    that address, before it logs in, and gives it back when it leaves the
+    pipeline. In a download batch only the leader does, since the whole
+    batch logs in and downloads through it (see BatchDownloads). The
+    address with the fewest leases is picked, ties going to the lowest
+    error rate over its last `window` downloads. Addresses where at least
+    `max_error_rate` of those failed are only used when all are. The
+    current state is kept in `status_path`.
+    '''
+    def __init__(self, addresses, session_pool_dir, status_path, window=20,
+                 max_error_rate=0.5):
+        self.addresses = addresses
+        self.session_pool_dir = session_pool_dir
+        self.status_path = status_path
+        self.max_error_rate = max_error_rate
+        self._leases = dict((address, 0) for address in addresses)
+        self._outcomes = dict(
+            (address, collections.deque(maxlen=window)) for address in addresses)
+
+    def error_rate(self, address):
+        outcomes = self._outcomes[address]
+
+        if len(outcomes) < 4:
+            return 0.0
+
+        return outcomes.count(False) / float(len(outcomes))
+
+    def lease(self, item):
+        healthy = [address for address in self.addresses
+                   if self.error_rate(address) < self.max_error_rate]
+        address = min(healthy or self.addresses, key=lambda address: (
+            self._leases[address], self.error_rate(address)))
+        name = address or 'default'
+
+        item["bind_address"] = address
+        item["address_name"] = name
+        item["session_pool"] = os.path.join(self.session_pool_dir, name)
+
+        if not os.path.isdir(item["session_pool"]):
+            os.makedirs(item["session_pool"])
+
+        self._leases[address] += 1
+        item.on_finish += self._release
+
+        if address:
+            item.log_output('Using address %s (%d items, %.0f%% recent errors).' % (
+                address, self._leases[address], 100 * self.error_rate(address)))
+
+        self._write_status()
+
+    def _release(self, item):
+        self._leases[item["bind_address"]] -= 1
+        self._write_status()
+
+    def watch(self, task):
+        '''Counts the items `task` completes or fails against their address.'''
+        task.on_complete_item += functools.partial(self._record, True)
+        task.on_fail_item += functools.partial(self._record, False)
+
+    def _record(self, success, task, item):
+        if item.get("bind_address") in self._outcomes:
+            self._outcomes[item["bind_address"]].append(success)
+            self._write_status()
+
+    def _write_status(self):
+        status = dict(
+            (address or 'default', {
+                'leases': self._leases[address],
+                'error_rate': round(self.error_rate(address), 3),
+                'downloads': len(self._outcomes[address]),
+            })
+            for address in self.addresses)
+
+        try:
+            with open(self.status_path + '.tmp', 'w') as out_file:
+                json.dump(status, out_file, indent=2, sort_keys=True)
+
+            os.rename(self.status_path + '.tmp', self.status_path)
+        except (IOError, OSError):
+            pass
+
+
+class LeaseAddress(SimpleTask):
+    def __init__(self, address_pool):
+        SimpleTask.__init__(self, "LeaseAddress")
+        self.address_pool = address_pool
+
+    def process(self, item):
+        self.address_pool.lease(item)
+
+
+class BatchRsyncUpload(RsyncUpload):
+    '''RsyncUpload of a batch, run for its first item.
+
+    The output and the tries are added to every item of the batch.
+    '''
+    def __init__(self, items, *args, **kwargs):
+        RsyncUpload.__init__(self, *args, **kwargs)
+        self.items = items
+
+    def enqueue(self, item):
+        for batch_item in self.items:
+            batch_item["tries"] = 0
+
+        RsyncUpload.enqueue(self, item)
+
+    def on_subprocess_stdout(self, pipe, item, data):
+        for batch_item in self.items:
+            batch_item.log_output(data, full_line=False)
+
+    def handle_process_error(self, exit_code, item):
+        for batch_item in self.items:
+            if batch_item is not item:
+                batch_item["tries"] += 1
+                batch_item.log_output(
+                    "Process %s returned exit code %d for %s\n" %
+                    (self, exit_code, batch_item.description()))
+                batch_item.log_error(self, exit_code)
+
+        RsyncUpload.handle_process_error(self, exit_code, item)
+
+
+class BatchedUploadWithTracker(UploadWithTracker):
+    '''UploadWithTracker that sends the files of several items in one rsync.
+
+    Items with the same rsync target are collected until there are
+    `batch_items` of them, their files add up to `batch_bytes` or the first
+    has waited `batch_wait` seconds. At most `concurrency` uploads run at
+    once; while they do, batches keep growing. Curl uploads are not
+    batched. Each item still asks the tracker for its own target and is
+    reported on its own.
+    '''
+    def __init__(self, tracker_url, downloader, files, concurrency=1,
+                 batch_items=10, batch_bytes=100 * 1024 * 1024, batch_wait=30,
+                 **kwargs):
+        UploadWithTracker.__init__(self, tracker_url, downloader, files, **kwargs)
+        self.concurrency = concurrency
+        self.batch_items = batch_items
+        self.batch_bytes = batch_bytes
+        self.batch_wait = batch_wait
+        self._batches = {}
+        self._unbatched = []
+        self._uploading = 0
+
+    def process_body(self, body, item):
+        target = json.loads(body).get("upload_target", "")
+
+        if re.match(r"^https?://.+/$", target):
+            # Curl uploads one item at a time, within the same limit.
+            self._unbatched.append((body, item))
+            self._upload_due()
+            return
+        elif not re.match(r"^rsync://.+/$", target):
+            UploadWithTracker.process_body(self, body, item)
+            return
+
+        batch = self._batches.get(target)
+
+        if batch is None:
+            batch = self._batches[target] = {
+                'items': [],
+                'bytes': 0,
+                'started': time.time(),
+            }
+            IOLoop.instance().add_timeout(
+                datetime.timedelta(seconds=self.batch_wait), self._upload_due)
+
+        batch['items'].append(item)
+        batch['bytes'] += sum(
+            os.path.getsize(path) for path in realize(self.files, item))
+        item.log_output("Waiting to upload to %s with %d other items." % (
+            target, len(batch['items']) - 1))
+
+        self._upload_due()
+
+    def _is_due(self, batch):
+        return len(batch['items']) >= self.batch_items or \
+            batch['bytes'] >= self.batch_bytes or \
+            time.time() - batch['started'] >= self.batch_wait
+
+    def _upload_due(self):
+        while self._unbatched:
+            body, item = self._unbatched[0]
+
+            if self._uploading >= realize(self.concurrency, item):
+                return
+
+            self._unbatched.pop(0)
+            self._uploading += 1
+            UploadWithTracker.process_body(self, body, item)
+
+        for target, batch in list(self._batches.items()):
+            if self._uploading >= realize(self.concurrency, batch['items'][0]):
+                return
+
+            if self._is_due(batch):
+                del self._batches[target]
+                self._upload(target, batch['items'])
+
+    def _upload(self, target, items):
+        self._uploading += 1
+        files = [path for item in items for path in realize(self.files, item)]
+
+        for item in items:
+            item.log_output("Uploading %d items with Rsync to %s" % (
+                len(items), target))
+
+        # The items' files live in different directories, so send them by
+        # absolute path and flatten them on the target.
+        inner_task = BatchRsyncUpload(
+            items, target, files,
+            target_source_path="/",
+            bwlimit=self.rsync_bwlimit,
+            extra_args=self.rsync_extra_args + ["--no-relative"],
+            max_tries=1)
+        inner_task.on_complete_item += functools.partial(self._batch_complete, items)
+        inner_task.on_fail_item += functools.partial(self._batch_fail, items)
+        inner_task.enqueue(items[0])
+
+    def _inner_task_complete_item(self, task, item):
+        self._uploading -= 1
+        UploadWithTracker._inner_task_complete_item(self, task, item)
+        self._upload_due()
+
+    def _inner_task_fail_item(self, task, item):
+        self._uploading -= 1
+        UploadWithTracker._inner_task_fail_item(self, task, item)
+        self._upload_due()
+
+    def _batch_complete(self, items, task, carrier):
+        self._uploading -= 1
+
+        for item in items:
+            self.complete_item(item)
+
+        self._upload_due()
+
+    def _batch_fail(self, items, task, carrier):
+        self._uploading -= 1
+
+        for item in items:
+            self.schedule_retry(item)
+
+        self._upload_due()
+
+
+class StageMetrics(object):
+    '''Records how long every item spends in each task of a pipeline.
+
+    For each task, and each task BatchDownloads runs items through, the
+    queue wait (from being handed to the task until it starts on the
+    item), the wall time, the size of the item's WARC at the end and the
+    outcome are recorded. Each finished item is appended as a line to
+    `log_path`, and `prom_path` is rewritten in the Prometheus textfile
+    format with percentiles over the last `window` items.
+    '''
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, pipeline, prom_path, log_path, window=200):
+        self.prom_path = prom_path
+        self.log_path = log_path
+        self.window = window
+        self._stages = []
+        self._records = {}
+        self._wall_times = {}
+        self._wait_times = {}
+        self._totals = {}
+
+        for task in pipeline.tasks:
+            self._instrument(task)
+
+            # The tasks BatchDownloads runs the leader of a batch through
+            for inner_task in getattr(task, 'inner_tasks', ()):
+                self._instrument(inner_task)
+
+        pipeline.on_finish_item += self._item_finished
+
+    def _instrument(self, task):
+        stage = self._stage_name(task)
+        self._stages.append(stage)
+        self._wall_times[stage] = collections.deque(maxlen=self.window)
+        self._wait_times[stage] = collections.deque(maxlen=self.window)
+        self._totals[stage] = collections.Counter()
+
+        task.enqueue = functools.partial(self._enqueue, stage, task.enqueue)
+        # Not on_complete_item and on_fail_item: the pipeline's own
+        # handler may run first and carry the item through the next
+        # stages before this one is recorded.
+        task.complete_item = functools.partial(self._finish, stage, 'completed', task.complete_item)
+        task.fail_item = functools.partial(self._finish, stage, 'failed', task.fail_item)
+
+        # LimitConcurrent only starts its inner task, and only once a
+        # slot is free.
+        for started_task in (task, getattr(task, 'inner_task', None)):
+            if started_task is not None:
+                started_task.on_start_item += functools.partial(self._start, stage)
+
+    @staticmethod
+    def _stage_name(task):
+        if isinstance(task, LimitConcurrent):
+            return task.inner_task.name
+
+        return task.name
+
+    def _record(self, stage, item):
+        return self._records.setdefault(item, {}).setdefault(stage, {})
+
+    def _enqueue(self, stage, enqueue, item):
+        self._record(stage, item)['queued'] = time.time()
+        enqueue(item)
+
+    def _start(self, stage, task, item):
+        record = self._records.get(item, {}).get(stage)
+
+        if record and 'queued' in record and 'started' not in record:
+            record['started'] = time.time()
+
+    def _finish(self, stage, outcome, finish, item):
+        record = self._records.get(item, {}).get(stage)
+
+        if record and 'queued' in record and 'finished' not in record:
+            record['finished'] = time.time()
+            record.setdefault('started', record['queued'])
+            record['outcome'] = outcome
+            record['bytes'] = self._warc_size(item)
+
+        finish(item)
+
+    @staticmethod
+    def _warc_size(item):
+        if 'warc_file_base' not in item:
+            return 0
+
+        for dir_key in ('item_dir', 'data_dir'):
+            path = "%s/%s.warc.gz" % (item[dir_key], item['warc_file_base'])
+
+            if os.path.exists(path):
+                return os.path.getsize(path)
+
+        return 0
+
+    def _item_finished(self, pipeline, item):
+        records = self._records.pop(item, {})
+        stages = []
+
+        for stage in self._stages:
+            record = records.get(stage)
+
+            if not record or 'queued' not in record:
+                continue
+
+            if 'finished' not in record:
+                record['finished'] = time.time()
+                record.setdefault('started', record['finished'])
+                record['outcome'] = 'canceled' if item.canceled else 'unfinished'
+                record['bytes'] = self._warc_size(item)
+
+            wait_time = record['started'] - record['queued']
+            wall_time = record['finished'] - record['started']
+
+            self._wait_times[stage].append(wait_time)
+            self._wall_times[stage].append(wall_time)
+            totals = self._totals[stage]
+            totals['count'] += 1
+            totals['wait_seconds'] += wait_time
+            totals['wall_seconds'] += wall_time
+            totals['bytes'] += record['bytes']
+            totals['outcome:' + record['outcome']] += 1
+
+            stages.append({
+                'stage': stage,
+                'queue_wait': round(wait_time, 3),
+                'wall_time': round(wall_time, 3),
+                'bytes': record['bytes'],
+                'outcome': record['outcome'],
+            })
+
+        if not stages:
+            return
+
+        try:
+            with io.open(self.log_path, 'a', encoding='utf8') as out_file:
+                out_file.write(json.dumps({
+                    'item': item.get('item_name'),
+                    'finished': round(time.time(), 3),
+                    'outcome': 'completed' if item.completed else 'canceled' if item.canceled else 'failed',
+                    'stages': stages,
+                }) + u'\n')
+
+            self._write_textfile()
+        except (IOError, OSError) as error:
+            item.log_output('Could not write stage metrics: {0}'.format(error))
+
+    @staticmethod
+    def _percentile(values, quantile):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(quantile * len(values)))]
+
+    def _write_textfile(self):
+        lines = []
+
+        for metric, help_text, times, total_key in (
+                ('fagrab_stage_wall_seconds', 'Time items spent running in each pipeline stage.',
+                 self._wall_times, 'wall_seconds'),
+                ('fagrab_stage_queue_seconds', 'Time items waited before each pipeline stage started on them.',
+                 self._wait_times, 'wait_seconds')):
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s summary' % metric)
+
+            for stage in self._stages:
+                if not times[stage]:
+                    continue
+
+                for quantile in self.QUANTILES:
+                    lines.append('%s{stage="%s",quantile="%s"} %.3f' % (
+                        metric, stage, quantile, self._percentile(times[stage], quantile)))
+
+                lines.append('%s_sum{stage="%s"} %.3f' % (metric, stage, self._totals[stage][total_key]))
+                lines.append('%s_count{stage="%s"} %d' % (metric, stage, self._totals[stage]['count']))
+
+        lines.append('# HELP fagrab_stage_bytes_total Size of the item WARCs when each stage finished.')
+        lines.append('# TYPE fagrab_stage_bytes_total counter')
+
+        for stage in self._stages:
+            if self._totals[stage]['count']:
+                lines.append('fagrab_stage_bytes_total{stage="%s"} %d' % (stage, self._totals[stage]['bytes']))
+
+        lines.append('# HELP fagrab_stage_items_total Items that left each stage, by outcome.')
+        lines.append('# TYPE fagrab_stage_items_total counter')
+
+        for stage in self._stages:
+            for key, count in sorted(self._totals[stage].items()):
+                if key.startswith('outcome:'):
+                    lines.append('fagrab_stage_items_total{stage="%s",outcome="%s"} %d' % (
+                        stage, key.split(':', 1)[1], count))
+
+        temp_path = self.prom_path + '.tmp'
+
+        with io.open(temp_path, 'w', encoding='utf8') as out_file:
+            out_file.write(u'\n'.join(lines) + u'\n')
+
+        os.rename(temp_path, self.prom_path)
+
+
 def get_hash(filename):
+    hashes = startup_cache.setdefault('hashes', {})
+    signature = file_signature(filename)
+    cached = hashes.get(filename)
+
+    if cached and cached['signature'] == signature:
+        return cached['sha1']
+
     with open(filename, 'rb') as in_file:
-        return hashlib.sha1(in_file.read()).hexdigest()
+        sha1 = hashlib.sha1(in_file.read()).hexdigest()
+
+    hashes[filename] = {'signature': signature, 'sha1': sha1}
+    save_startup_cache()
+
+    return sha1
 
 
-CWD = os.getcwd()
 PIPELINE_SHA1 = get_hash(os.path.join(CWD, 'pipeline.py'))
 SCRIPT_SHA1 = get_hash(os.path.join(CWD, 'furaffinity.py'))
 HELPER_SHA1 = get_hash(os.path.join(CWD, 'helper.py'))
@@ -185,11 +1560,71 @@ def stats_id_function(item):
         'script_hash': SCRIPT_SHA1,
         'helper_hash': HELPER_SHA1,
         'python_version': sys.version,
+        'cost_estimate': item.get('cost_estimate'),
     }
 
     return d
 
 
+def seed_urls(item_name):
+    item_type, item_value = item_name.split(':', 1)
+    urls = []
+
+    if item_type == 'profile':
+        username = item_value
+        assert ',' not in username, 'multi user not supported {0}'.format(item_value)
+
+        urls.extend([
+            'https://www.furaffinity.net/user/{0}/'.format(username),
+            'https://www.furaffinity.net/commissions/{0}/'.format(username),
+            'https://www.furaffinity.net/journals/{0}/'.format(username),
+            'https://www.furaffinity.net/gallery/{0}/'.format(username),
+            'https://www.furaffinity.net/scraps/{0}/'.format(username),
+        ])
+
+        if username not in ('nacht', 'virus-20', 'redmagejacob'):
+            urls.append('https://www.furaffinity.net/favorites/{0}/'.format(username))
+
+    elif item_type == 'journal':
+        start_num, end_num = item_value.split('-', 1)
+        nums = list(range(int(start_num), int(end_num) + 1))
+        random.shuffle(nums)
+
+        for num in nums:
+            urls.append(
+                'https://www.furaffinity.net/journal/{0}/'.format(num)
+            )
+
+    elif item_type == 'submission':
+        start_num, end_num = item_value.split('-', 1)
+        nums = list(range(int(start_num), int(end_num) + 1))
+        random.shuffle(nums)
+
+        for num in nums:
+            urls.extend([
+                'https://www.furaffinity.net/view/{0}/'.format(num),
+                # 'https://www.furaffinity.net/full/{0}/'.format(num),
+                # enable full view in profile settings
+            ])
+
+    else:
+        raise Exception('Unknown item type.')
+
+    return urls
+
+
+class MinWait(object):
+    '''The shortest wait between requests to FA for an item, in seconds.
+
+    The hooks pace FA themselves, so this goes to them instead of --wait.
+    '''
+    def realize(self, item):
+        if item['item_name'].startswith('submission:'):
+            return '2'
+
+        return '0'
+
+
 class WgetArgs(object):
     def realize(self, item):
         wget_args = [
@@ -216,61 +1651,27 @@ class WgetArgs(object):
             "--waitretry", "30",
             # "--domains", "furaffinity.net,facdn.net",
             "--warc-file", ItemInterpolation("%(item_dir)s/%(warc_file_base)s"),
+            "--warc-cdx",
+            "--warc-dedup", DEDUP_INDEX,
             "--warc-header", "operator: Archive Team",
             "--warc-header", "furaffinity-dld-script-version: " + VERSION,
-            "--warc-header", ItemInterpolation("furaffinity-user: %(item_name)s"),
+            "--warc-header", "furaffinity-user: " + (
+                item.get('batch_item_names') or item['item_name']),
         ]
 
-        item_type, item_value = item['item_name'].split(':', 1)
-
-        if item_type == 'profile':
-            username = item_value
-            assert ',' not in username, 'multi user not supported {0}'.format(item_value)
-
-            wget_args.extend([
-                'https://www.furaffinity.net/user/{0}/'.format(username),
-                'https://www.furaffinity.net/commissions/{0}/'.format(username),
-                'https://www.furaffinity.net/journals/{0}/'.format(username),
-                'https://www.furaffinity.net/gallery/{0}/'.format(username),
-                'https://www.furaffinity.net/scraps/{0}/'.format(username),
-            ])
-
-            if username not in ('nacht', 'virus-20', 'redmagejacob'):
-                wget_args.append('https://www.furaffinity.net/favorites/{0}/'.format(username))
-
-        elif item_type == 'journal':
-            start_num, end_num = item_value.split('-', 1)
-            nums = list(range(int(start_num), int(end_num) + 1))
-            random.shuffle(nums)
-
-            for num in nums:
-                wget_args.append(
-                    'https://www.furaffinity.net/journal/{0}/'.format(num)
-                )
-
-        elif item_type == 'submission':
-            wget_args.remove("--wait=1")
-            wget_args.append("--wait=2")
+        for item_name in (item.get('batch_item_names') or item['item_name']).split(','):
+            wget_args.extend(seed_urls(item_name))
 
-            start_num, end_num = item_value.split('-', 1)
-            nums = list(range(int(start_num), int(end_num) + 1))
-            random.shuffle(nums)
+        if SIMULATOR:
+            # Not through http_proxy: wpull wants HOST:PORT without a
+            # scheme, and would speak TLS to the proxy with https_proxy set.
+            wget_args.extend(['--http-proxy', SIMULATOR])
 
-            for num in nums:
-                wget_args.extend([
-                    'https://www.furaffinity.net/view/{0}/'.format(num),
-                    # 'https://www.furaffinity.net/full/{0}/'.format(num),
-                    # enable full view in profile settings
-                ])
-
-        else:
-            raise Exception('Unknown item type.')
-
-        if 'bind_address' in globals():
-            wget_args.extend(['--bind-address', globals()['bind_address']])
+        if item.get('bind_address'):
+            wget_args.extend(['--bind-address', item['bind_address']])
             print('')
             print('*** Wget will bind address at {0} ***'.format(
-                globals()['bind_address']))
+                item['bind_address']))
             print('')
 
         return realize(wget_args, item)
@@ -298,50 +1699,110 @@ project = Project(
     # utc_deadline=datetime.datetime(2000, 1, 1, 23, 59, 0)
 )
 
+download = WgetDownload(
+    WgetArgs(),
+    max_tries=1,
+    accept_on_exit_code=[0, 4, 7, 8],
+    env={
+        "item_dir": ItemValue("item_dir"),
+        "downloader": downloader,
+        "item_name": ItemValue("item_name"),
+        "batch_item_names": ItemInterpolation("%(batch_item_names)s"),
+        "rate_file": ItemInterpolation(os.path.join(STATE_DIR, 'rate-%(address_name)s.json')),
+        "cdn_filter": CDN_FILTER,
+        "min_wait": MinWait(),
+        "frontier_memory": globals().get('frontier_memory', '64'),
+        "hook_profile": globals().get('hook_profile', ''),
+    }
+)
+
+# Local addresses to spread the downloads over, e.g. 10.0.0.1,10.0.0.2
+BIND_ADDRESSES = [
+    address.strip() for address in
+    (globals().get('bind_addresses') or globals().get('bind_address') or '').split(',')
+    if address.strip()
+] or ['']
+
+address_pool = AddressPool(
+    BIND_ADDRESSES, SESSION_POOL_DIR, os.path.join(STATE_DIR, 'address_pool.json'))
+
+begin = ExternalProcess(
+    'Begin',
+    [sys.executable, 'helper.py', 'begin'],
+    env=dict({
+        'user_agent': user_agent,
+        'bind_address': ItemValue("bind_address"),
+        'disco_tracker': DISCO_TRACKER_URL,
+        "item_dir": ItemValue("item_dir"),
+        'session_pool': ItemValue("session_pool"),
+        'session_pool_size': globals().get('session_pool_size', '6'),
+    }, **SIMULATOR_ENV),
+    accept_on_exit_code=[0],
+)
+
+end = ExternalProcess(
+    'End',
+    [sys.executable, 'helper.py', 'end'],
+    env=dict({
+        'user_agent': user_agent,
+        'bind_address': ItemValue("bind_address"),
+        'disco_tracker': DISCO_TRACKER_URL,
+        "item_dir": ItemValue("item_dir"),
+        'session_pool': ItemValue("session_pool"),
+        'session_pool_size': globals().get('session_pool_size', '6'),
+        'username_cache': os.path.join(STATE_DIR, 'reported_usernames.db'),
+        'username_cache_ttl': globals().get('username_cache_ttl', '86400'),
+        'username_cache_size': globals().get('username_cache_size', '1000000'),
+        'compress_uploads': globals().get('compress_uploads', ''),
+    }, **SIMULATOR_ENV),
+    accept_on_exit_code=[0],
+)
+address_pool.watch(begin)
+address_pool.watch(download)
+
+batch_download = BatchDownloads(
+    [
+        LeaseAddress(address_pool),
+        begin,
+        LimitConcurrent(
+            NumberConfigValue(
+                min=1, max=6, default=globals().get("num_procs", "1"),
+                name="shared:fagrab:num_procs", title="Number of Processes",
+                description="The maximum number of concurrent download processes."
+            ),
+            download,
+        ),
+        end,
+    ],
+    batch_items=NumberConfigValue(
+        min=1, max=20, default=globals().get("download_batch_items", "1"),
+        name="shared:fagrab:download_batch_items", title="Items per download process",
+        description="The number of submission or journal items downloaded by one process."
+    ),
+    batch_wait=int(globals().get('download_batch_wait', 30)),
+)
+
 pipeline = Pipeline(
     CheckIP(),
-    GetItemFromTracker("http://%s/%s" % (TRACKER_HOST, TRACKER_ID), downloader,
-                       VERSION),
-    PrepareDirectories(warc_prefix="furaffinity"),
-    ExternalProcess(
-        'Begin',
-        [sys.executable, 'helper.py', 'begin'],
-        env={
-            'user_agent': user_agent,
-            'bind_address': globals().get('bind_address', ''),
-            'disco_tracker': DISCO_TRACKER_URL,
-            "item_dir": ItemValue("item_dir"),
-        },
-        accept_on_exit_code=[0],
-    ),
-    LimitConcurrent(
+    LimitPrefetch(
         NumberConfigValue(
-            min=1, max=6, default=globals().get("num_procs", "1"),
-            name="shared:fagrab:num_procs", title="Number of Processes",
-            description="The maximum number of concurrent download processes."
-        ),
-        WgetDownload(
-            WgetArgs(),
-            max_tries=1,
-            accept_on_exit_code=[0, 4, 7, 8],
-            env={
-                "item_dir": ItemValue("item_dir"),
-                "downloader": downloader,
-                "item_name": ItemValue("item_name"),
-            }
+            min=1, max=6, default=globals().get("prefetch_items", "1"),
+            name="shared:fagrab:prefetch_items", title="Items to prefetch",
+            description="The number of items claimed and prepared while waiting for a download process."
         ),
+        download,
+        batch_download,
     ),
-    ExternalProcess(
-        'End',
-        [sys.executable, 'helper.py', 'end'],
-        env={
-            'user_agent': user_agent,
-            'bind_address': globals().get('bind_address', ''),
-            'disco_tracker': DISCO_TRACKER_URL,
-            "item_dir": ItemValue("item_dir"),
-        },
-        accept_on_exit_code=[0],
+    GetItemFromTracker("http://%s/%s" % (TRACKER_HOST, TRACKER_ID), downloader,
+                       VERSION),
+    PrepareDirectories(
+        warc_prefix="furaffinity",
+        resume=globals().get('resume_items', '1') != '0',
+        resume_max_age=int(globals().get('resume_max_age', 2 * 86400)),
     ),
+    batch_download,
+    ReadCostEstimate(),
+    MergeWarcSegments(warc_prefix="furaffinity"),
     PrepareStatsForTracker(
         defaults={"downloader": downloader, "version": VERSION},
         file_groups={
@@ -352,27 +1813,43 @@ pipeline = Pipeline(
         id_function=stats_id_function,
     ),
     MoveFiles(),
-    LimitConcurrent(
-        NumberConfigValue(min=1, max=4, default="1",
-                          name="shared:rsync_threads", title="Rsync threads",
-                          description="The maximum number of concurrent uploads."),
-        UploadWithTracker(
-            "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
-            downloader=downloader,
-            version=VERSION,
-            files=[
-                ItemInterpolation("%(data_dir)s/%(warc_file_base)s.warc.gz"),
-            ],
-            rsync_target_source_path=ItemInterpolation("%(data_dir)s/"),
-            rsync_extra_args=[
-                "--recursive",
-                "--partial",
-                "--partial-dir", ".rsync-tmp",
-                ]
-        ),
+    BatchedUploadWithTracker(
+        "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+        downloader=downloader,
+        version=VERSION,
+        files=[
+            ItemInterpolation("%(data_dir)s/%(warc_file_base)s.warc.gz"),
+        ],
+        concurrency=NumberConfigValue(
+            min=1, max=4, default="1",
+            name="shared:rsync_threads", title="Rsync threads",
+            description="The maximum number of concurrent uploads."),
+        batch_items=int(globals().get('upload_batch_items', 10)),
+        batch_bytes=int(globals().get('upload_batch_bytes', 100 * 1024 * 1024)),
+        batch_wait=int(globals().get('upload_batch_wait', 30)),
+        rsync_extra_args=[
+            "--recursive",
+            "--partial",
+            "--partial-dir", ".rsync-tmp",
+            ]
     ),
     SendDoneToTracker(
         tracker_url="http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
         stats=ItemValue("stats")
-    )
+    ),
+    # Only once the WARC is uploaded, or later items would point revisit
+    # records at, or skip, files that were never archived.
+    UpdateDedupIndex(DEDUP_INDEX),
+    ExternalProcess(
+        'UpdateCDNFilter',
+        [sys.executable, 'cdnfilter.py', 'build', CDN_FILTER,
+         ItemInterpolation("%(data_dir)s/%(warc_file_base)s.cdx")],
+        accept_on_exit_code=[0],
+    ),
+)
+
+stage_metrics = StageMetrics(
+    pipeline,
+    prom_path=globals().get('metrics_textfile', os.path.join(STATE_DIR, 'stage_metrics.prom')),
+    log_path=os.path.join(STATE_DIR, 'stage_metrics.jsonl'),
 )
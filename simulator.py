@@ -0,0 +1,543 @@
+'''Local stand-in for furaffinity.net, facdn.net and the trackers.
+
+Serves made-up profiles, submissions, journals and CDN files, handles
+logging in and out, answers the disco tracker's get_secrets and username
+discovery calls and hands out items like the universal tracker. Nothing
+leaves the machine, so whole items, concurrency settings and backoff can be
+load tested offline:
+
+    python3 simulator.py --port 8080 --latency 0.2 --error-rate 0.01
+    run-pipeline pipeline.py --context-value simulator=127.0.0.1:8080 ...
+
+The pipeline then sends wpull and helper.py through the simulator as an
+HTTP(S) proxy, so the scripts see the real hostnames, and talks to it
+directly as the tracker. HTTPS is answered with a self-signed certificate
+for the simulated hosts, made with openssl on the first run and kept in
+state/simulator/.
+'''
+import argparse
+import base64
+import collections
+import gzip
+import http.cookies
+import http.server
+import json
+import os
+import random
+import socketserver
+import ssl
+import subprocess
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+
+
+STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state', 'simulator')
+
+FA_HOSTS = ('www.furaffinity.net', 'furaffinity.net')
+CDN_HOSTS = ('d.facdn.net', 't.facdn.net', 'a.facdn.net')
+DISCO_HOST = 'tracker.archiveteam.org'
+
+USERNAME = 'simulator'
+PASSWORD = 'simulator'
+
+# Submissions with ids divisible by this are missing, like deleted ones.
+MISSING_EVERY = 97
+
+
+def make_certificate(directory):
+    '''Returns the paths of the certificate and key, creating them if needed.'''
+    cert_path = os.path.join(directory, 'cert.pem')
+    key_path = os.path.join(directory, 'key.pem')
+
+    if not os.path.exists(cert_path):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-keyout', key_path, '-out', cert_path, '-days', '3650',
+            '-subj', '/CN=FurAffinity simulator',
+            '-addext', 'subjectAltName=' + ','.join(
+                'DNS:' + host for host in FA_HOSTS + CDN_HOSTS + (DISCO_HOST,)),
+        ])
+
+    return cert_path, key_path
+
+
+class Site(object):
+    '''The simulated content. Everything is derived from names and ids.'''
+    def __init__(self, submissions, favorites, journals, page_size, cdn_size):
+        self.submissions = submissions
+        self.favorites = favorites
+        self.journals = journals
+        self.page_size = page_size
+        self.cdn_file = b'\x89PNG\r\n\x1a\n' + b'\0' * max(0, cdn_size - 8)
+        self.sessions = set()
+        self.lock = threading.Lock()
+
+    def user(self, name):
+        if name.startswith('missing'):
+            return None
+
+        rand = random.Random(name)
+        first_id = (zlib.crc32(name.encode('utf8')) % 100000) * 10000 + 1
+        num_submissions = rand.randint(0, self.submissions * 2)
+        num_scraps = num_submissions // 5
+
+        return {
+            'name': name,
+            'gallery': list(range(first_id, first_id + num_submissions - num_scraps)),
+            'scraps': list(range(first_id + num_submissions - num_scraps, first_id + num_submissions)),
+            'favorites': [rand.randint(1, 999999999) for dummy in range(rand.randint(0, self.favorites * 2))],
+            'journals': list(range(first_id, first_id + rand.randint(0, self.journals * 2))),
+            'watchers': ['user{0}'.format(rand.randint(1, 1000000)) for dummy in range(20)],
+        }
+
+    @staticmethod
+    def artist(submission_id):
+        return 'artist{0}'.format(submission_id // 10000)
+
+    def page(self, body, logged_in, title='FurAffinity'):
+        if logged_in:
+            account = (
+                '<a href="/user/{0}/">{0}</a> <a href="/logout/">Log Out</a>\n'
+                '<a href="/controls/settings/">Toggle to hide Mature and Adult submissions.</a>\n'
+            ).format(USERNAME)
+        else:
+            account = '<a href="/login/">Log In</a>\n'
+
+        return (
+            '<!DOCTYPE html>\n<html><head><title>{0}</title>\n'
+            '<link rel="stylesheet" href="//a.facdn.net/themes/classic/css/style.css">\n'
+            '</head><body>\n<div id="nav"><a href="/">Home</a> '
+            '<a href="/commissions/{1}/">Commission Info</a>\n{2}</div>\n'
+            '{3}\n<div id="footer">Page generated in 0.012 seconds.</div>\n'
+            '</body></html>\n'
+        ).format(title, USERNAME, account, body).encode('utf8')
+
+    def thumbnails(self, submission_ids):
+        return ''.join(
+            '<b id="sid_{0}"><a href="/view/{0}/"><img src="//t.facdn.net/{0}@200-1434600000.jpg"></a></b>\n'.format(
+                submission_id)
+            for submission_id in submission_ids
+        )
+
+    def render(self, path, logged_in):
+        '''Returns (status, body) for a furaffinity.net path.'''
+        parts = [part for part in path.split('/') if part]
+
+        if not parts:
+            return 200, self.page('<h2>Welcome</h2>', logged_in)
+
+        if parts[0] in ('view', 'full') and len(parts) == 2 and parts[1].isdigit():
+            submission_id = int(parts[1])
+
+            if submission_id % MISSING_EVERY == 0:
+                return 200, self.page(
+                    'The submission you are trying to find is not in our database.', logged_in)
+
+            artist = self.artist(submission_id)
+            return 200, self.page(
+                '<b>Submission information:</b> by <a href="/user/{0}/">{0}</a>\n'
+                '<script>var is_full = 1;</script>\n'
+                '<img src="//d.facdn.net/art/{0}/{1}.{0}_picture.png">\n'
+                '<a href="//d.facdn.net/art/{0}/{1}.{0}_picture.png">Download</a>\n'.format(
+                    artist, submission_id),
+                logged_in)
+
+        if parts[0] == 'journal' and len(parts) == 2 and parts[1].isdigit():
+            journal_id = int(parts[1])
+
+            if journal_id % MISSING_EVERY == 0:
+                return 200, self.page(
+                    'The journal you are trying to find is not in our database.', logged_in)
+
+            return 200, self.page(
+                '<h2>Journal {0}</h2> by <a href="/user/{1}/">{1}</a>'.format(
+                    journal_id, self.artist(journal_id)), logged_in)
+
+        if len(parts) < 2:
+            return 404, self.page('Not found.', logged_in)
+
+        user = self.user(parts[1].lower())
+
+        if user is None:
+            return 200, self.page('This user cannot be found.', logged_in)
+
+        if parts[0] == 'user':
+            return 200, self.page(
+                '<h2>{0}</h2>\n<b>Submissions:</b> {1}<br/>\n<b>Favs:</b> {2}<br/>\n'
+                '<b>Journals:</b> {3}<br/>\n{4}'.format(
+                    user['name'], len(user['gallery']) + len(user['scraps']),
+                    len(user['favorites']), len(user['journals']),
+                    ''.join('<a href="/user/{0}/">{0}</a>\n'.format(name) for name in user['watchers'])),
+                logged_in)
+
+        if parts[0] in ('gallery', 'scraps', 'favorites'):
+            page_num = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 1
+            start = (page_num - 1) * self.page_size
+            submission_ids = user[parts[0]][start:start + self.page_size]
+
+            if not submission_ids:
+                return 200, self.page('There are no submissions to list', logged_in)
+
+            body = self.thumbnails(submission_ids)
+
+            if start + self.page_size < len(user[parts[0]]):
+                body += '<a class="button-link right" href="/{0}/{1}/{2}/">Next</a>\n'.format(
+                    parts[0], user['name'], page_num + 1)
+
+            return 200, self.page(body, logged_in)
+
+        if parts[0] == 'journals':
+            return 200, self.page(''.join(
+                '<a href="/journal/{0}/">Journal {0}</a>\n'.format(journal_id)
+                for journal_id in user['journals']), logged_in)
+
+        if parts[0] == 'commissions':
+            return 200, self.page('No commission types.', logged_in)
+
+        return 404, self.page('Not found.', logged_in)
+
+
+class RateLimiter(object):
+    '''Token bucket over all furaffinity.net and facdn.net requests.'''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.rate:
+            return True
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+            return True
+
+
+class Tracker(object):
+    '''Hands out items and counts the finished ones.'''
+    def __init__(self, item_type, tracker_id='furaffinity'):
+        self.item_type = item_type
+        self.tracker_id = tracker_id
+        self.next_num = 1
+        self.claimed = 0
+        self.done = 0
+        self.usernames = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def next_item(self):
+        with self.lock:
+            num = self.next_num
+            self.next_num += 1
+            self.claimed += 1
+
+        if self.item_type == 'profile':
+            return 'profile:user{0}'.format(num)
+
+        first = num * 100
+
+        return '{0}:{1}-{2}'.format(self.item_type, first, first + 99)
+
+    def items_per_hour(self):
+        return self.done / max(1.0, time.time() - self.started) * 3600
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    tunnel_host = None
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_CONNECT(self):
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        self.wfile.flush()
+
+        self.tunnel_host = self.path.split(':', 1)[0].lower()
+        self.connection = self.server.ssl_context.wrap_socket(self.connection, server_side=True)
+        self.rfile = self.connection.makefile('rb', self.rbufsize)
+        self.wfile = self.connection.makefile('wb')
+        self.close_connection = False
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def do_HEAD(self):
+        self.dispatch()
+
+    def dispatch(self):
+        url = urllib.parse.urlsplit(self.path)
+
+        if url.hostname:
+            # A plain HTTP request through the proxy
+            host = url.hostname
+        else:
+            host = self.tunnel_host or (self.headers.get('host') or '').split(':', 1)[0].lower()
+
+        if host in FA_HOSTS or host in CDN_HOSTS:
+            status, headers, content = self.handle_site(host, url.path, self.read_body())
+        elif host == DISCO_HOST and url.path.startswith('/_fa_disco/'):
+            status, headers, content = self.handle_disco(url.path, self.read_body())
+        else:
+            host = 'tracker'
+            status, headers, content = self.handle_tracker(url.path)
+
+        self.server.count(host, status)
+
+        self.send_response(status)
+
+        for name, value in headers:
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def read_body(self, discard=False):
+        remaining = int(self.headers.get('content-length') or 0)
+        chunks = []
+
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1048576))
+
+            if not chunk:
+                break
+
+            remaining -= len(chunk)
+
+            if discard:
+                chunks.append(len(chunk))
+            else:
+                chunks.append(chunk)
+
+        if discard:
+            return sum(chunks)
+
+        return b''.join(chunks)
+
+    def handle_site(self, host, path, body):
+        server = self.server
+
+        if not server.rate_limiter.allow():
+            return 429, [('Content-Type', 'text/plain')], b'Too many requests.'
+
+        is_cdn = host in CDN_HOSTS
+        latency = server.cdn_latency if is_cdn else server.latency
+
+        if latency:
+            time.sleep(random.uniform(0.5, 1.5) * latency)
+
+        if server.error_rate and random.random() < server.error_rate:
+            return 503, [('Content-Type', 'text/html')], b'<h1>Service Unavailable</h1>'
+
+        if is_cdn:
+            return 200, [('Content-Type', 'image/png')], server.site.cdn_file
+
+        cookies = http.cookies.SimpleCookie(self.headers.get('cookie') or '')
+        token = cookies['a'].value if 'a' in cookies else None
+        logged_in = token in server.site.sessions
+
+        if path.startswith('/login/') and self.command == 'POST':
+            form = urllib.parse.parse_qs(body.decode('utf8', 'replace'))
+
+            if form.get('name') == [USERNAME] and form.get('pass') == [PASSWORD]:
+                token = uuid.uuid4().hex
+
+                with server.site.lock:
+                    server.site.sessions.add(token)
+
+                return 302, [
+                    ('Location', 'https://www.furaffinity.net/'),
+                    ('Set-Cookie', 'a={0}; Domain=.furaffinity.net; Path=/; Max-Age=31536000'.format(token)),
+                ], b''
+
+            return 200, [('Content-Type', 'text/html')], server.site.page(
+                'Wrong username or password.', False)
+
+        if path.startswith('/logout/'):
+            with server.site.lock:
+                server.site.sessions.discard(token)
+
+            return 302, [
+                ('Location', 'https://www.furaffinity.net/'),
+                ('Set-Cookie', 'a=; Domain=.furaffinity.net; Path=/; Max-Age=0'),
+            ], b''
+
+        status, content = server.site.render(path, logged_in)
+
+        return status, [('Content-Type', 'text/html; charset=utf-8')], content
+
+    def handle_disco(self, path, body):
+        if path.endswith('/api/get_secrets'):
+            return 200, [('Content-Type', 'application/json')], json.dumps({
+                'username': USERNAME,
+                'password': base64.b64encode(PASSWORD.encode('ascii')).decode('ascii'),
+            }).encode('ascii')
+
+        if path.endswith('/api/user_discovery') or path.endswith('/api/user_private_discovery'):
+            if self.headers.get('content-encoding') == 'gzip':
+                body = gzip.decompress(body)
+
+            results = json.loads(body.decode('utf8'))
+
+            with self.server.tracker.lock:
+                self.server.tracker.usernames += len(results.get('discovered_usernames', ()))
+
+            return 200, [('Content-Type', 'text/plain')], b'OK'
+
+        return 404, [('Content-Type', 'text/plain')], b'Not found.'
+
+    def handle_tracker(self, path):
+        tracker = self.server.tracker
+        prefix = '/' + tracker.tracker_id
+
+        if path.startswith('/uploads/') and self.command == 'PUT':
+            uploaded_bytes = self.read_body(discard=True)
+
+            with tracker.lock:
+                self.server.uploaded_bytes += uploaded_bytes
+
+            return 200, [('Content-Type', 'text/plain')], b'OK'
+
+        self.read_body(discard=True)
+
+        if path == prefix + '/request':
+            return 200, [('Content-Type', 'application/json')], json.dumps({
+                'item_name': tracker.next_item(),
+            }).encode('ascii')
+
+        if path == prefix + '/upload':
+            return 200, [('Content-Type', 'application/json')], json.dumps({
+                'upload_target': 'http://{0}/uploads/'.format(self.headers.get('host')),
+            }).encode('ascii')
+
+        if path == prefix + '/done':
+            with tracker.lock:
+                tracker.done += 1
+
+            return 200, [('Content-Type', 'text/plain')], b'OK'
+
+        return 404, [('Content-Type', 'text/plain')], b'Not found.'
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, site, tracker, ssl_context, latency=0.0,
+                 cdn_latency=0.0, error_rate=0.0, rate_limit=0.0, verbose=False):
+        http.server.HTTPServer.__init__(self, address, Handler)
+        self.site = site
+        self.tracker = tracker
+        self.ssl_context = ssl_context
+        self.latency = latency
+        self.cdn_latency = cdn_latency
+        self.error_rate = error_rate
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.verbose = verbose
+        self.requests = collections.Counter()
+        self.uploaded_bytes = 0
+
+    def count(self, host, status):
+        with self.tracker.lock:
+            self.requests[(host, status)] += 1
+
+    def report(self):
+        tracker = self.tracker
+
+        with tracker.lock:
+            requests = sorted(self.requests.items())
+
+        print('{0} items claimed, {1} done, {2:.1f} items/hour, {3} usernames, {4} bytes uploaded'.format(
+            tracker.claimed, tracker.done, tracker.items_per_hour(),
+            tracker.usernames, self.uploaded_bytes))
+        print('  ' + ', '.join('{0} {1}: {2}'.format(host, status, count)
+                               for (host, status), count in requests))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate FurAffinity and the trackers locally.')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='mean seconds before a furaffinity.net response')
+    parser.add_argument('--cdn-latency', type=float, default=0.0,
+                        help='mean seconds before a facdn.net response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of site requests answered with 503')
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='site requests per second before 429s, 0 for no limit')
+    parser.add_argument('--submissions', type=int, default=100,
+                        help='mean number of submissions per profile')
+    parser.add_argument('--favorites', type=int, default=100,
+                        help='mean number of favorites per profile')
+    parser.add_argument('--journals', type=int, default=5,
+                        help='mean number of journals per profile')
+    parser.add_argument('--page-size', type=int, default=48,
+                        help='thumbnails per gallery, scraps or favorites page')
+    parser.add_argument('--cdn-size', type=int, default=50000,
+                        help='size of each facdn.net file in bytes')
+    parser.add_argument('--item-type', default='profile',
+                        choices=('profile', 'submission', 'journal'))
+    parser.add_argument('--report-interval', type=float, default=60.0)
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    cert_path, key_path = make_certificate(STATE_DIR)
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(cert_path, key_path)
+
+    server = Server(
+        (args.address, args.port),
+        Site(args.submissions, args.favorites, args.journals, args.page_size, args.cdn_size),
+        Tracker(args.item_type),
+        ssl_context,
+        latency=args.latency,
+        cdn_latency=args.cdn_latency,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        verbose=args.verbose,
+    )
+
+    def report_periodically():
+        while True:
+            time.sleep(args.report_interval)
+            server.report()
+
+    thread = threading.Thread(target=report_periodically)
+    thread.daemon = True
+    thread.start()
+
+    print('Simulating on {0}:{1}. Certificate: {2}'.format(args.address, args.port, cert_path))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.report()
+
+
+if __name__ == '__main__':
+    main()